@@ -1,7 +1,6 @@
 # detectron2 imports and setup. Make sure detectron2 is installed.
 import torch, detectron2
 from detectron2 import model_zoo
-from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer
 from detectron2.utils.video_visualizer import VideoVisualizer
@@ -9,6 +8,11 @@ from detectron2.data import MetadataCatalog, DatasetCatalog
 from detectron2.utils.visualizer import ColorMode
 from detectron2.engine import DefaultTrainer
 from detectron2.data.datasets import register_coco_panoptic_separated
+from detectron2.modeling import build_model
+from detectron2.checkpoint import DetectionCheckpointer
+import detectron2.data.transforms as T
+from detectron2.modeling.postprocessing import detector_postprocess, sem_seg_postprocess
+from detectron2.modeling.meta_arch.panoptic_fpn import combine_semantic_and_instance_outputs
 
 from detectron2.utils.logger import setup_logger
 setup_logger()
@@ -22,6 +26,474 @@ import sys
 import cv2
 from natsort import natsorted
 import json
+import itertools
+import queue
+import threading
+import collections
+import contextlib
+import csv
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows, peak RSS is not reported there
+  resource = None
+
+def peakRssMB():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  if sys.platform == "darwin":
+    return round(peak / (1024 * 1024), 1)
+  return round(peak / 1024, 1)
+
+class StageMetrics:
+  """
+  Collects per-stage latencies (decode, preprocess, model, postprocess, render, encode) of a run.
+  Latencies are recorded per frame, so a batch of n frames counts as n frames of 1/n of its time.
+  Reports p50/p95/p99 latencies, the overall and rolling frames per second and the peak RSS,
+  and exports them as JSON and CSV. With streamInterval, a summary line is appended to
+  streamFile and printed every streamInterval seconds.
+  """
+  STAGES = ["decode", "preprocess", "model", "postprocess", "render", "encode"]
+
+  def __init__(self, streamInterval=None, streamFile=None, rollingWindow=60):
+    self.latencies = collections.defaultdict(list)
+    self.frameTimes = collections.deque(maxlen=rollingWindow)
+    self.numFrames = 0
+    self.startTime = None
+    self.lock = threading.Lock()
+
+    self.streamInterval = streamInterval
+    self.streamFile = streamFile
+    self.lastStreamTime = time.time()
+
+  def record(self, stage, seconds, numFrames=1):
+    with self.lock:
+      if self.startTime is None:
+        self.startTime = time.time() - seconds
+      self.latencies[stage].extend([seconds / numFrames] * numFrames)
+
+  @contextlib.contextmanager
+  def measure(self, stage, numFrames=1):
+    start = time.perf_counter()
+    yield
+    self.record(stage, time.perf_counter() - start, numFrames)
+
+  def frameDone(self):
+    # Called once a frame has been written
+    now = time.time()
+    with self.lock:
+      self.numFrames += 1
+      self.frameTimes.append(now)
+
+    if self.streamInterval is not None and now - self.lastStreamTime >= self.streamInterval:
+      self.lastStreamTime = now
+      self.stream()
+
+  def rollingFps(self):
+    with self.lock:
+      frameTimes = list(self.frameTimes)
+    if len(frameTimes) < 2 or frameTimes[-1] == frameTimes[0]:
+      return None
+    return round((len(frameTimes) - 1) / (frameTimes[-1] - frameTimes[0]), 3)
+
+  def stageSummary(self, stage):
+    with self.lock:
+      latencies = np.array(self.latencies[stage])
+    if len(latencies) == 0:
+      return None
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+      "frames": len(latencies),
+      "total_s": round(float(latencies.sum()), 4),
+      "mean_ms": round(float(latencies.mean() * 1000), 3),
+      "p50_ms": round(float(p50), 3),
+      "p95_ms": round(float(p95), 3),
+      "p99_ms": round(float(p99), 3),
+    }
+
+  def summary(self):
+    elapsedTime = time.time() - self.startTime if self.startTime is not None else 0.0
+    stages = [stage for stage in self.STAGES if stage in self.latencies]
+    stages += sorted(stage for stage in self.latencies if stage not in self.STAGES)
+    return {
+      "frames": self.numFrames,
+      "elapsed_s": round(elapsedTime, 3),
+      "fps": round(self.numFrames / elapsedTime, 3) if elapsedTime > 0 else None,
+      "rolling_fps": self.rollingFps(),
+      "peak_rss_mb": peakRssMB(),
+      "stages": {stage: self.stageSummary(stage) for stage in stages},
+    }
+
+  def stream(self):
+    summary = self.summary()
+    if self.streamFile is not None:
+      with open(self.streamFile, "a") as f:
+        f.write(json.dumps(dict(summary, time=time.time())) + "\n")
+
+    rollingFps = summary["rolling_fps"]
+    print("frames: " + str(summary["frames"]) + ", rolling fps: " + (str(rollingFps) if rollingFps else "-")
+          + ", peak RSS MB: " + str(summary["peak_rss_mb"]))
+
+  def export(self, jsonFile, csvFile):
+    summary = self.summary()
+    with open(jsonFile, "w") as f:
+      json.dump(summary, f, indent=4)
+
+    columns = ["frames", "total_s", "mean_ms", "p50_ms", "p95_ms", "p99_ms"]
+    with open(csvFile, "w", newline="") as f:
+      writer = csv.writer(f)
+      writer.writerow(["stage"] + columns)
+      for stage, stageSummary in summary["stages"].items():
+        writer.writerow([stage] + [stageSummary[column] for column in columns])
+
+    return summary
+
+  def printSummary(self, summary):
+    print("Stage latencies per frame (ms):")
+    for stage, stageSummary in summary["stages"].items():
+      print("  " + stage.ljust(12) + " p50 " + str(stageSummary["p50_ms"]) + ", p95 " + str(stageSummary["p95_ms"])
+            + ", p99 " + str(stageSummary["p99_ms"]))
+    print("Frames per second: " + str(summary["fps"]) + ", peak RSS MB: " + str(summary["peak_rss_mb"]))
+
+class BatchPredictor:
+  """
+  Like detectron2's DefaultPredictor, but runs a list of BGR frames through the model in a
+  single forward pass. Returns one output dict (with "panoptic_seg") per frame.
+  """
+  def __init__(self, cfg, metrics=None):
+    self.cfg = cfg.clone()
+    self.metrics = metrics
+    self.model = build_model(self.cfg)
+    self.model.eval()
+
+    checkpointer = DetectionCheckpointer(self.model)
+    checkpointer.load(cfg.MODEL.WEIGHTS)
+
+    self.aug = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+    self.inputFormat = cfg.INPUT.FORMAT
+
+    # CUDA runs asynchronously, so it has to be synchronized for the stage timings to be right
+    self.synchronize = str(self.cfg.MODEL.DEVICE).startswith("cuda")
+
+    # PanopticFPN can return its raw outputs, so their postprocessing can be timed separately
+    self.splitPostprocess = hasattr(self.model, "combine_on") and hasattr(self.model, "inference")
+
+  @contextlib.contextmanager
+  def measure(self, stage, numFrames):
+    if self.metrics is None:
+      yield
+      return
+    with self.metrics.measure(stage, numFrames):
+      yield
+      if self.synchronize:
+        torch.cuda.synchronize()
+
+  def postprocess(self, inputs, detectorResults, semSegResults):
+    # Same as PanopticFPN.inference with do_postprocess=True
+    outputs = []
+    for semSegResult, detectorResult, inputPerImage in zip(semSegResults, detectorResults, inputs):
+      height, width = inputPerImage["height"], inputPerImage["width"]
+      imageSize = inputPerImage["image"].shape[-2:]
+      semSegR = sem_seg_postprocess(semSegResult, imageSize, height, width)
+      detectorR = detector_postprocess(detectorResult, height, width)
+      outputs.append({"sem_seg": semSegR, "instances": detectorR})
+
+      if self.model.combine_on:
+        outputs[-1]["panoptic_seg"] = combine_semantic_and_instance_outputs(
+          detectorR,
+          semSegR.argmax(dim=0),
+          self.model.combine_overlap_thresh,
+          self.model.combine_stuff_area_thresh,
+          self.model.combine_instances_score_thresh,
+        )
+    return outputs
+
+  def __call__(self, frames):
+    with torch.no_grad():
+      with self.measure("preprocess", len(frames)):
+        inputs = []
+        for frame in frames:
+          if self.inputFormat == "RGB":
+            frame = frame[:, :, ::-1]
+          height, width = frame.shape[:2]
+          image = self.aug.get_transform(frame).apply_image(frame)
+          image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+          inputs.append({"image": image, "height": height, "width": width})
+
+      if not self.splitPostprocess:
+        with self.measure("model", len(frames)):
+          return self.model(inputs)
+
+      with self.measure("model", len(frames)):
+        detectorResults, semSegResults = self.model.inference(inputs, do_postprocess=False)
+      with self.measure("postprocess", len(frames)):
+        return self.postprocess(inputs, detectorResults, semSegResults)
+
+class FastPanopticRenderer:
+  """
+  Draws panoptic predictions on a BGR frame with a few vectorized NumPy passes instead of
+  detectron2's matplotlib based Visualizer. The segment colors are blended in with one lookup
+  table pass, contours are the pixels whose segment differs from their right or bottom neighbor,
+  and the class name sprites are rendered once and cached.
+  Label positions are the segment centroids, computed on every 4th row and column of the frame.
+  The palette comes from the metadata's thing_colors and stuff_colors, which are the categories JSON
+  (labels.py) colors for fine-tuned models. Thing instances get a slightly jittered class color.
+  """
+  def __init__(self, metaData, alpha=0.5, drawContours=True, drawLabels=True, minLabelArea=1000):
+    self.thingClasses = metaData.get("thing_classes", [])
+    self.stuffClasses = metaData.get("stuff_classes", [])
+    self.thingColors = self.getPalette(metaData.get("thing_colors", None), len(self.thingClasses))
+    self.stuffColors = self.getPalette(metaData.get("stuff_colors", None), len(self.stuffClasses))
+
+    self.alpha = alpha
+    self.drawContours = drawContours
+    self.drawLabels = drawLabels
+    self.minLabelArea = minLabelArea
+
+    self.instanceJitter = np.random.RandomState(0).randint(-40, 41, size=(64, 3))
+    self.sprites = {}
+    self.grids = {}
+
+  def getPalette(self, colors, numClasses):
+    # Metadata colors are RGB and frames are BGR. Classes without a color get a fixed random one.
+    palette = np.random.RandomState(numClasses).randint(0, 256, size=(numClasses, 3))
+    if colors is not None:
+      n = min(len(colors), numClasses)
+      palette[:n] = np.array(colors[:n]).reshape(n, 3)
+    return palette[:, ::-1].astype(np.int32)
+
+  def segmentColor(self, segment):
+    if segment["isthing"]:
+      color = self.thingColors[segment["category_id"]] + self.instanceJitter[segment["id"] % len(self.instanceJitter)]
+      return np.clip(color, 0, 255)
+    return self.stuffColors[segment["category_id"]]
+
+  def segmentName(self, segment):
+    classes = self.thingClasses if segment["isthing"] else self.stuffClasses
+    return classes[segment["category_id"]]
+
+  def getSprite(self, text, color, fontScale):
+    # Text with a black outline, drawn once per class name and color
+    key = (text, tuple(color), fontScale)
+    if key not in self.sprites:
+      thickness = max(1, int(round(fontScale * 2)))
+      (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, fontScale, thickness + 2)
+      sprite = np.zeros((height + baseline + 4, width + 4, 3), dtype=np.uint8)
+      origin = (2, height + 2)
+      cv2.putText(sprite, text, origin, cv2.FONT_HERSHEY_SIMPLEX, fontScale, (1, 1, 1), thickness + 2, cv2.LINE_AA)
+      mask = sprite[:, :, 0] > 0
+      cv2.putText(sprite, text, origin, cv2.FONT_HERSHEY_SIMPLEX, fontScale, tuple(int(c) for c in color), thickness, cv2.LINE_AA)
+      self.sprites[key] = (sprite, mask)
+    return self.sprites[key]
+
+  def pasteSprite(self, image, sprite, mask, centerX, centerY):
+    height, width = mask.shape
+    x0 = int(centerX) - width // 2
+    y0 = int(centerY) - height // 2
+    ix0, iy0 = max(x0, 0), max(y0, 0)
+    ix1, iy1 = min(x0 + width, image.shape[1]), min(y0 + height, image.shape[0])
+    if ix0 >= ix1 or iy0 >= iy1:
+      return
+
+    region = image[iy0:iy1, ix0:ix1]
+    spriteMask = mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+    region[spriteMask] = sprite[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0][spriteMask]
+
+  def getGrids(self, shape):
+    # Pixel coordinates of every 4th row and column
+    if shape not in self.grids:
+      ys, xs = np.mgrid[0:shape[0]:4, 0:shape[1]:4]
+      self.grids[shape] = (xs.ravel().astype(np.float64), ys.ravel().astype(np.float64))
+    return self.grids[shape]
+
+  def render(self, frame, panopticSeg, segmentsInfo):
+    """frame is a BGR image, panopticSeg the (H, W) segment id array and segmentsInfo its segments."""
+    numIds = max([segment["id"] for segment in segmentsInfo], default=0) + 1
+    colors = np.zeros((numIds, 3), dtype=np.uint8)
+    for segment in segmentsInfo:
+      colors[segment["id"]] = self.segmentColor(segment)
+
+    # np.take is much faster than fancy indexing for a (H, W) lookup into a small table
+    overlay = np.take(colors, panopticSeg, axis=0)
+    out = cv2.addWeighted(frame, 1 - self.alpha, overlay, self.alpha, 0)
+
+    # Unlabeled pixels (id 0) keep the frame colors
+    unlabeled = panopticSeg == 0
+    out[unlabeled] = frame[unlabeled]
+
+    if self.drawContours:
+      boundary = np.zeros(panopticSeg.shape, dtype=bool)
+      boundary[:, :-1] |= panopticSeg[:, :-1] != panopticSeg[:, 1:]
+      boundary[:-1, :] |= panopticSeg[:-1, :] != panopticSeg[1:, :]
+      boundary &= panopticSeg != 0
+      out[boundary] = colors[panopticSeg[boundary]]
+
+    if self.drawLabels and segmentsInfo:
+      flatSeg = panopticSeg[::4, ::4].ravel()
+      xs, ys = self.getGrids(panopticSeg.shape)
+      counts = np.bincount(flatSeg, minlength=numIds)
+      sumX = np.bincount(flatSeg, weights=xs, minlength=numIds)
+      sumY = np.bincount(flatSeg, weights=ys, minlength=numIds)
+      fontScale = max(round(panopticSeg.shape[0] / 1000, 1), 0.4)
+
+      for segment in segmentsInfo:
+        segId = segment["id"]
+        if counts[segId] * 16 < self.minLabelArea:
+          continue
+        # Text in a lighter version of the class color, like the Visualizer
+        classColor = self.thingColors[segment["category_id"]] if segment["isthing"] else self.stuffColors[segment["category_id"]]
+        textColor = classColor + (255 - classColor) // 2
+        sprite, mask = self.getSprite(self.segmentName(segment), textColor, fontScale)
+        self.pasteSprite(out, sprite, mask, sumX[segId] / counts[segId], sumY[segId] / counts[segId])
+
+    return out
+
+class KeyframeScheduler:
+  """
+  Runs the model only on keyframes and reuses the last keyframe's panoptic segmentation for the
+  frames in between. A frame is a keyframe every `interval` frames, or when the mean absolute
+  difference between its downscaled grayscale image and the last keyframe's exceeds `diffThreshold`.
+  The keyframe segmentation is warped to the other frames with dense optical flow computed
+  at a width of `flowWidth` pixels.
+  Whether a frame is a keyframe depends on the last keyframe, so keyframes are run through the model
+  one at a time and batch_size doesn't apply in keyframe mode.
+  """
+  def __init__(self, interval=None, diffThreshold=None, flowWidth=320, metrics=None):
+    self.metrics = metrics
+    self.interval = interval
+    self.diffThreshold = diffThreshold
+    self.flowWidth = flowWidth
+    self.numFrames = 0
+    self.modelCalls = 0
+
+  def smallGray(self, frame):
+    height, width = frame.shape[:2]
+    scale = min(1.0, self.flowWidth / width)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (int(round(width * scale)), int(round(height * scale))), interpolation=cv2.INTER_AREA)
+
+  def isKeyframe(self, gray, keyGray, sinceKeyframe):
+    if keyGray is None:
+      return True
+    if self.interval is not None and sinceKeyframe >= self.interval:
+      return True
+    if self.diffThreshold is not None:
+      return cv2.absdiff(gray, keyGray).mean() > self.diffThreshold
+    return False
+
+  def warpSegmentation(self, keySeg, keyGray, gray):
+    # Backward warp: each pixel of the current frame takes the segment id at the position
+    # the optical flow (current frame -> keyframe) points to in the keyframe
+    flow = cv2.calcOpticalFlowFarneback(gray, keyGray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    height, width = keySeg.shape
+    scaleX = width / gray.shape[1]
+    scaleY = height / gray.shape[0]
+    flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    mapX, mapY = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    mapX += flow[:, :, 0] * scaleX
+    mapY += flow[:, :, 1] * scaleY
+
+    # Segment ids are small integers, so float32 holds them exactly
+    warped = cv2.remap(keySeg.astype(np.float32), mapX, mapY, cv2.INTER_NEAREST, borderMode=cv2.BORDER_REPLICATE)
+    return warped.astype(keySeg.dtype)
+
+  def __call__(self, predictor, frames):
+    """Yields (frame, panoptic_seg, segments_info) for every frame."""
+    keyGray = None
+    sinceKeyframe = 0
+    for frame in frames:
+      self.numFrames += 1
+      gray = self.smallGray(frame)
+
+      if self.isKeyframe(gray, keyGray, sinceKeyframe):
+        panoptic_seg, segments_info = predictor([frame])[0]["panoptic_seg"]
+        self.modelCalls += 1
+        keySeg = panoptic_seg.to("cpu").numpy()
+        keyGray = gray
+        keyInfo = segments_info
+        sinceKeyframe = 1
+        yield frame, panoptic_seg, segments_info
+      else:
+        sinceKeyframe += 1
+        start = time.perf_counter()
+        warped = self.warpSegmentation(keySeg, keyGray, gray)
+        if self.metrics is not None:
+          self.metrics.record("warp", time.perf_counter() - start)
+        yield frame, torch.from_numpy(warped), keyInfo
+
+  def report(self):
+    saved = self.numFrames - self.modelCalls
+    percent = 100 * saved / max(self.numFrames, 1)
+    print("The model ran on " + str(self.modelCalls) + " of " + str(self.numFrames) + " frames, "
+          + str(saved) + " model calls saved (" + str(round(percent, 1)) + "%)")
+
+def panopticQuality(references, predictions):
+  """
+  Panoptic quality of predicted (panoptic_seg, segments_info) pairs against reference pairs,
+  matching segments of the same category with IoU > 0.5 like the COCO panoptic evaluation.
+  Pixels with id 0 in the reference are ignored. Returns (PQ, SQ, RQ) averaged over categories.
+  """
+  iouSums, tps, fps, fns = {}, {}, {}, {}
+  for (refSeg, refInfo), (predSeg, predInfo) in zip(references, predictions):
+    refSeg = np.asarray(refSeg, dtype=np.int64)
+    predSeg = np.asarray(predSeg, dtype=np.int64)
+    refCategories = {s["id"]: (s["isthing"], s["category_id"]) for s in refInfo}
+    predCategories = {s["id"]: (s["isthing"], s["category_id"]) for s in predInfo}
+
+    # Intersections of every (reference, predicted) segment pair with one bincount
+    numPred = int(predSeg.max()) + 1
+    pairs = np.bincount((refSeg * numPred + predSeg).ravel())
+    pairIds = np.nonzero(pairs)[0]
+    refAreas = np.bincount(refSeg.ravel())
+    predAreas = np.bincount(predSeg.ravel(), minlength=numPred)
+
+    matchedRef, matchedPred = set(), set()
+    voidOverlap = {}
+    for pairId in pairIds:
+      refId, predId = divmod(int(pairId), numPred)
+      intersection = int(pairs[pairId])
+      if refId == 0:
+        voidOverlap[predId] = intersection
+        continue
+      if predId == 0 or refCategories.get(refId) != predCategories.get(predId):
+        continue
+      # The pixels of the predicted segment on unlabeled reference pixels don't count in the union
+      union = refAreas[refId] + predAreas[predId] - intersection - pairs[predId]
+      iou = intersection / union
+      if iou > 0.5:
+        category = refCategories[refId]
+        iouSums[category] = iouSums.get(category, 0.0) + iou
+        tps[category] = tps.get(category, 0) + 1
+        matchedRef.add(refId)
+        matchedPred.add(predId)
+
+    for refId, category in refCategories.items():
+      if refId not in matchedRef and refId < len(refAreas) and refAreas[refId] > 0:
+        fns[category] = fns.get(category, 0) + 1
+    for predId, category in predCategories.items():
+      if predId in matchedPred or predId >= numPred or predAreas[predId] == 0:
+        continue
+      # Predicted segments that are mostly on unlabeled reference pixels aren't false positives
+      if voidOverlap.get(predId, 0) / predAreas[predId] > 0.5:
+        continue
+      fps[category] = fps.get(category, 0) + 1
+
+  pqs, sqs, rqs = [], [], []
+  for category in set(tps) | set(fps) | set(fns):
+    tp, fp, fn = tps.get(category, 0), fps.get(category, 0), fns.get(category, 0)
+    sq = iouSums[category] / tp if tp else 0.0
+    rq = tp / (tp + 0.5 * fp + 0.5 * fn)
+    pqs.append(sq * rq)
+    sqs.append(sq)
+    rqs.append(rq)
+
+  if not pqs:
+    return 1.0, 1.0, 1.0
+  return float(np.mean(pqs)), float(np.mean(sqs)), float(np.mean(rqs))
 
 class PSVideoApp:
   def __init__(self):
@@ -42,6 +514,46 @@ class PSVideoApp:
     self.confidenceVal = configDict["confidence_val"]
     self.folderName = configDict["folder_name"]
 
+    # Frames are streamed from the video through the model into the output video.
+    # Set "save_frames" to dump the input and output frames to disk as jpg images instead.
+    self.saveFrames = configDict.get("save_frames", False)
+
+    # Number of frames run through the model in one forward pass, and the device to run it on ("cpu" or "cuda")
+    self.batchSize = configDict.get("batch_size", 1)
+    self.device = configDict.get("device", None)
+
+    # Set "benchmark_batch_sizes" to only report the inference throughput for batch sizes 1 to batch_size
+    self.benchmarkBatches = configDict.get("benchmark_batch_sizes", False)
+    self.benchmarkFrames = configDict.get("benchmark_frames", 32)
+
+    # Set "pipelined" to decode, run inference, render and encode in parallel threads.
+    # "queue_size" is the number of batches each stage can get ahead of the next one.
+    self.pipelined = configDict.get("pipelined", False)
+    self.queueSize = configDict.get("queue_size", 4)
+
+    # "renderer" is "visualizer" (detectron2's Visualizer) or "fast" (FastPanopticRenderer)
+    self.rendererName = configDict.get("renderer", "visualizer")
+    self.overlayAlpha = configDict.get("overlay_alpha", 0.5)
+    self.drawContours = configDict.get("draw_contours", True)
+    self.drawLabels = configDict.get("draw_labels", True)
+    self.fastRenderer = None
+
+    # Set "keyframe_interval" and/or "keyframe_diff_threshold" to run the model only on keyframes and warp
+    # its output to the frames in between. "keyframe_drift_frames" compares keyframe mode with full
+    # inference on the first frames of the video instead of making the video.
+    self.keyframeInterval = configDict.get("keyframe_interval", None)
+    self.keyframeDiffThreshold = configDict.get("keyframe_diff_threshold", None)
+    self.keyframeDriftFrames = configDict.get("keyframe_drift_frames", None)
+    self.useKeyframes = self.keyframeInterval is not None or self.keyframeDiffThreshold is not None
+    if self.useKeyframes and self.batchSize > 1:
+      print("Keyframe mode runs the keyframes through the model one at a time, batch_size is ignored.")
+
+    # Per-stage latencies are saved to 'folder_name'/metrics.json and metrics.csv at the end of a run.
+    # Set "metrics_interval" to also print a summary and append it to metrics_stream.jsonl every that many seconds.
+    metricsInterval = configDict.get("metrics_interval", None)
+    streamFile = os.path.join(self.folderName, "metrics_stream.jsonl") if metricsInterval is not None else None
+    self.metrics = StageMetrics(metricsInterval, streamFile)
+
     print("Finished reading the config.json file.")
 
   def makeOutputFolder(self):
@@ -51,6 +563,13 @@ class PSVideoApp:
     inputFramesFolder = os.path.join(folderName, "inVideoFrames")
     outputFramesFolder = os.path.join(folderName, "outVideoFrames")
 
+    if not os.path.exists(folderName):
+      os.makedirs(folderName)
+
+    if not self.saveFrames:
+      print("Finished making the output folders.")
+      return
+
     if not os.path.exists(inputFramesFolder):
       os.makedirs(inputFramesFolder)
 
@@ -59,26 +578,62 @@ class PSVideoApp:
 
     print("Finished making the output folders.")
   
+  def readFrames(self):
+    # Opens the Video file and yields its frames one by one
+    cap = cv2.VideoCapture(self.videoFile)
+    try:
+      while(cap.isOpened()):
+          with self.metrics.measure("decode"):
+            ret, frame = cap.read()
+          if ret == False:
+              break
+          yield frame
+    finally:
+      cap.release()
+
+  def readBatches(self, batchSize):
+    # Groups the video frames into lists of batchSize frames. The last batch may be smaller.
+    frames = self.readFrames()
+    while True:
+      batch = list(itertools.islice(frames, batchSize))
+      if not batch:
+        break
+      yield batch
+
+  def makeKeyframeScheduler(self):
+    # The KeyframeScheduler of keyframe mode, or None to run the model on every frame
+    if not self.useKeyframes:
+      return None
+    return KeyframeScheduler(self.keyframeInterval, self.keyframeDiffThreshold, metrics=self.metrics)
+
+  def predictFrames(self, predictor, frames, scheduler=None):
+    # Yields (frame, panoptic_seg, segments_info) for every frame, running the model on batches of
+    # batchSize frames, or only on the keyframes picked by scheduler
+    if scheduler is not None:
+      yield from scheduler(predictor, frames)
+      return
+
+    while True:
+      batch = list(itertools.islice(frames, self.batchSize))
+      if not batch:
+        break
+      for frame, output in zip(batch, predictor(batch)):
+        panoptic_seg, segments_info = output["panoptic_seg"]
+        yield frame, panoptic_seg, segments_info
+
   def videoToFrames(self):
     print("Converting video to input frames in 'folder_name'/inVideoFrames...")
 
-    videoFile = self.videoFile
     folderName = self.folderName
 
-    # Opens the Video file
-    cap = cv2.VideoCapture(videoFile)
     i=0
-    while(cap.isOpened()):
-        ret, frame = cap.read()
-        if ret == False:
-            break
+    for frame in self.readFrames():
         frameImageName = str(i) + '.jpg'
         fullFramePath = os.path.join(folderName, 'inVideoFrames', frameImageName)
 
         cv2.imwrite(fullFramePath,frame)
         i+=1
     
-    cap.release()
     cv2.destroyAllWindows()
 
     print("Finished converting video to input frames. Total frames: " + str(i))
@@ -109,19 +664,12 @@ class PSVideoApp:
 
     return metaData, numStuffClasses, numThingClasses
 
-  def inferenceOnFrames(self):
-    print("Doing panoptic segmentation inference on input frames and storing in 'folder_name'/outVideoFrames...")
-
-    folderName = self.folderName
-    inputFramesFolder = os.path.join(folderName, "inVideoFrames")
-    outputFramesFolder = os.path.join(folderName, "outVideoFrames")
-
-    images = [img for img in os.listdir(inputFramesFolder) if img.endswith(".jpg")]
-    sortedImages = natsorted(images)
-
+  def buildPredictor(self):
     cfg = get_cfg()
     cfg.merge_from_file(model_zoo.get_config_file(self.psModel))
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = self.confidenceVal
+    if self.device is not None:
+      cfg.MODEL.DEVICE = self.device
 
     if(self.useFineTunedModel == True):
       #register dataset with cocopanoptic separated
@@ -147,21 +695,46 @@ class PSVideoApp:
       cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url(self.psModel)
       metaData = MetadataCatalog.get(cfg.DATASETS.TRAIN[0])
 
-    predictor = DefaultPredictor(cfg)
+    predictor = BatchPredictor(cfg, self.metrics)
+
+    return predictor, metaData
+
+  def renderFrame(self, frame, metaData, panoptic_seg, segments_info):
+    with self.metrics.measure("render"):
+      if self.rendererName == "fast":
+        if self.fastRenderer is None:
+          self.fastRenderer = FastPanopticRenderer(metaData, self.overlayAlpha, self.drawContours, self.drawLabels)
+        return self.fastRenderer.render(frame, panoptic_seg.to("cpu").numpy(), segments_info)
+
+      v = Visualizer(frame[:, :, ::-1], metaData, scale=1.0)
+      out = v.draw_panoptic_seg_predictions(panoptic_seg.to("cpu"), segments_info)
+      return out.get_image()[:, :, ::-1]
+
+  def inferenceOnFrames(self):
+    print("Doing panoptic segmentation inference on input frames and storing in 'folder_name'/outVideoFrames...")
+
+    folderName = self.folderName
+    inputFramesFolder = os.path.join(folderName, "inVideoFrames")
+    outputFramesFolder = os.path.join(folderName, "outVideoFrames")
+
+    images = [img for img in os.listdir(inputFramesFolder) if img.endswith(".jpg")]
+    sortedImages = natsorted(images)
+
+    predictor, metaData = self.buildPredictor()
 
     tracker = time.time()
 
+    scheduler = self.makeKeyframeScheduler()
+    ims = (cv2.imread(os.path.join(inputFramesFolder, image)) for image in sortedImages)
+
     i = 0
-    for image in sortedImages:
-      inImageFullPath = os.path.join(folderName, "inVideoFrames", image)
-      outImageFullPath = os.path.join(folderName, "outVideoFrames", image)
+    for image, (im, panoptic_seg, segments_info) in zip(sortedImages, self.predictFrames(predictor, ims, scheduler)):
+      outImageFullPath = os.path.join(outputFramesFolder, image)
 
-      im = cv2.imread(inImageFullPath)
-      panoptic_seg, segments_info = predictor(im)["panoptic_seg"]
-      v = Visualizer(im[:, :, ::-1], metaData, scale=1.0)
-      out = v.draw_panoptic_seg_predictions(panoptic_seg.to("cpu"), segments_info)
-        
-      cv2.imwrite(outImageFullPath, out.get_image()[:, :, ::-1])
+      outFrame = self.renderFrame(im, metaData, panoptic_seg, segments_info)
+      with self.metrics.measure("encode"):
+        cv2.imwrite(outImageFullPath, outFrame)
+      self.metrics.frameDone()
 
       i = i + 1
 
@@ -173,6 +746,8 @@ class PSVideoApp:
         print("It took this many seconds to process 1000 frames: " + str(elapsedTime))
 
     print("Finished doing inference.")
+    if scheduler is not None:
+      scheduler.report()
 
   def makeVideo(self):
     print("Compiling the video...")
@@ -198,16 +773,233 @@ class PSVideoApp:
 
     print("Finished making the video.")
 
+  def encodeFrames(self, outFrames):
+    # Writes the rendered frames to 'folder_name'/psVideo.avi and returns the number of frames written
+    videoName = os.path.join(self.folderName, "psVideo.avi")
+
+    video = None
+    tracker = time.time()
+
+    i = 0
+    numFrames = 0
+    for outFrame in outFrames:
+      if video is None:
+        height, width = outFrame.shape[:2]
+        fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+        video = cv2.VideoWriter(videoName, fourcc, 30, (width,height))
+      with self.metrics.measure("encode"):
+        video.write(np.ascontiguousarray(outFrame))
+      self.metrics.frameDone()
+
+      numFrames = numFrames + 1
+      i = i + 1
+
+      if(i == 1000):
+        i = 0
+        newTime = time.time()
+        elapsedTime = newTime - tracker
+        tracker = time.time()
+        print("It took this many seconds to process 1000 frames: " + str(elapsedTime))
+
+    if video is not None:
+      video.release()
+
+    return numFrames
+
+  def streamVideo(self):
+    print("Doing panoptic segmentation inference on the video frames and writing 'folder_name'/psVideo.avi...")
+
+    # Frames go straight from the video reader through the model and renderer into the video writer,
+    # without writing and re-reading jpg frames on disk
+    predictor, metaData = self.buildPredictor()
+    scheduler = self.makeKeyframeScheduler()
+    frames = self.predictFrames(predictor, self.readFrames(), scheduler)
+
+    numFrames = self.encodeFrames(
+      self.renderFrame(frame, metaData, panoptic_seg, segments_info) for frame, panoptic_seg, segments_info in frames
+    )
+
+    print("Finished making the video. Total frames: " + str(numFrames))
+    if scheduler is not None:
+      scheduler.report()
+
+  def runStage(self, name, function, inQueue, outQueue, stageTimes, errors):
+    # Applies function to every item of inQueue and puts the results in outQueue in the same order.
+    # None marks the end of the stream. With inQueue=None, function is a generator that produces the items.
+    stageTimes[name] = 0.0
+    try:
+      if inQueue is None:
+        items = function()
+        while True:
+          start = time.time()
+          item = next(items, None)
+          stageTimes[name] += time.time() - start
+          if item is None:
+            break
+          outQueue.put(item)
+      else:
+        while True:
+          item = inQueue.get()
+          if item is None:
+            break
+          start = time.time()
+          result = function(item)
+          stageTimes[name] += time.time() - start
+          outQueue.put(result)
+    except Exception as e:
+      errors.append(e)
+    finally:
+      outQueue.put(None)
+
+  def streamVideoPipelined(self):
+    print("Doing pipelined panoptic segmentation inference on the video frames and writing 'folder_name'/psVideo.avi...")
+
+    # Decoding, inference and rendering each run in their own thread and the main thread encodes the video.
+    # The stages are connected by bounded queues, so a slow stage makes the others wait instead of
+    # piling frames up in memory, and the frames stay in order because every stage is a single thread.
+    predictor, metaData = self.buildPredictor()
+    scheduler = self.makeKeyframeScheduler()
+
+    def infer(frames):
+      return [(frame, *output["panoptic_seg"]) for frame, output in zip(frames, predictor(frames))]
+
+    def keyframeBatches():
+      # In keyframe mode the model stage reads the decoded frames itself, since the scheduler needs
+      # them in order, and its busy time includes waiting for the decode stage
+      frames = (frame for batch in iter(decoded.get, None) for frame in batch)
+      predicted = scheduler(predictor, frames)
+      while True:
+        batch = list(itertools.islice(predicted, self.batchSize))
+        if not batch:
+          break
+        yield batch
+
+    def render(batch):
+      return [self.renderFrame(frame, metaData, panoptic_seg, segments_info) for frame, panoptic_seg, segments_info in batch]
+
+    decoded = queue.Queue(maxsize=self.queueSize)
+    inferred = queue.Queue(maxsize=self.queueSize)
+    rendered = queue.Queue(maxsize=self.queueSize)
+    stageTimes = {}
+    errors = []
+
+    stages = [
+      ("decode", lambda: self.readBatches(self.batchSize), None, decoded),
+      ("model", infer, decoded, inferred) if scheduler is None else ("model", keyframeBatches, None, inferred),
+      ("render", render, inferred, rendered),
+    ]
+    threads = [
+      threading.Thread(target=self.runStage, args=(name, function, inQueue, outQueue, stageTimes, errors), daemon=True)
+      for name, function, inQueue, outQueue in stages
+    ]
+    for thread in threads:
+      thread.start()
+
+    waitTime = [0.0]
+
+    def renderedFrames():
+      while True:
+        start = time.time()
+        outFrames = rendered.get()
+        waitTime[0] += time.time() - start
+        if outFrames is None:
+          break
+        yield from outFrames
+
+    start = time.time()
+    numFrames = self.encodeFrames(renderedFrames())
+    elapsedTime = time.time() - start
+
+    # A failed stage ends the stream early. The stages before it may be blocked on a full queue,
+    # so they are left to exit with the process.
+    if errors:
+      raise errors[0]
+
+    for thread in threads:
+      thread.join()
+
+    stageTimes["encode"] = elapsedTime - waitTime[0]
+    print("Finished making the video. Total frames: " + str(numFrames) + ", "
+          + str(round(numFrames / max(elapsedTime, 1e-9), 2)) + " frames per second")
+    for name, stageTime in stageTimes.items():
+      print("  " + name + " stage busy for " + str(round(stageTime, 2)) + " seconds")
+    if scheduler is not None:
+      scheduler.report()
+
+  def benchmarkBatchSizes(self):
+    print("Measuring the inference throughput for batch sizes 1 to " + str(self.batchSize) + "...")
+
+    predictor, metaData = self.buildPredictor()
+    frames = list(itertools.islice(self.readFrames(), self.benchmarkFrames))
+
+    # The first forward pass is much slower than the rest, so it is left out of the measurements
+    predictor(frames[:1])
+
+    for batchSize in range(1, self.batchSize + 1):
+      start = time.time()
+      for begin in range(0, len(frames), batchSize):
+        predictor(frames[begin:begin + batchSize])
+      elapsedTime = time.time() - start
+
+      print("batch size " + str(batchSize) + ": " + str(round(len(frames) / elapsedTime, 2)) + " frames per second, "
+            + str(round(1000 * elapsedTime / len(frames), 1)) + " ms per frame")
+
+    print("Finished measuring the inference throughput on " + str(len(frames)) + " frames.")
+
+  def checkKeyframeDrift(self):
+    print("Comparing keyframe mode with full inference on the first " + str(self.keyframeDriftFrames) + " frames...")
+
+    predictor, metaData = self.buildPredictor()
+    frames = list(itertools.islice(self.readFrames(), self.keyframeDriftFrames))
+
+    references = []
+    for begin in range(0, len(frames), self.batchSize):
+      for output in predictor(frames[begin:begin + self.batchSize]):
+        panoptic_seg, segments_info = output["panoptic_seg"]
+        references.append((panoptic_seg.to("cpu").numpy(), segments_info))
+
+    scheduler = KeyframeScheduler(self.keyframeInterval, self.keyframeDiffThreshold)
+    predictions = [
+      (panoptic_seg.to("cpu").numpy(), segments_info) for frame, panoptic_seg, segments_info in scheduler(predictor, frames)
+    ]
+
+    pq, sq, rq = panopticQuality(references, predictions)
+    print("Keyframe mode against full inference: PQ " + str(round(100 * pq, 2)) + ", SQ " + str(round(100 * sq, 2))
+          + ", RQ " + str(round(100 * rq, 2)))
+    scheduler.report()
+
+  def saveMetrics(self):
+    jsonFile = os.path.join(self.folderName, "metrics.json")
+    csvFile = os.path.join(self.folderName, "metrics.csv")
+    summary = self.metrics.export(jsonFile, csvFile)
+    self.metrics.printSummary(summary)
+    print("Saved the stage metrics to " + jsonFile + " and " + csvFile)
+
 def main():
   if len(sys.argv) != 2:
     print("Please run command with 1 arguments after the script name: config.json")
     sys.exit(0)
 
   psVideoApp = PSVideoApp()
+  if psVideoApp.benchmarkBatches:
+    psVideoApp.benchmarkBatchSizes()
+    return
+
+  if psVideoApp.keyframeDriftFrames:
+    psVideoApp.checkKeyframeDrift()
+    return
+
   psVideoApp.makeOutputFolder()
-  psVideoApp.videoToFrames()
-  psVideoApp.inferenceOnFrames()
-  psVideoApp.makeVideo()
+  if psVideoApp.saveFrames:
+    psVideoApp.videoToFrames()
+    psVideoApp.inferenceOnFrames()
+    psVideoApp.makeVideo()
+  elif psVideoApp.pipelined:
+    psVideoApp.streamVideoPipelined()
+  else:
+    psVideoApp.streamVideo()
+
+  psVideoApp.saveMetrics()
 
   print("Done. Look in 'folder_name' for the constructed panoptic segmentation video.")
 
@@ -0,0 +1,319 @@
+"""
+Benchmark suite for the preprocessing scripts on synthetic data, so they can be measured
+without downloading RUGD or RELLIS-3D.
+
+Usage Example:
+    python benchmarkPreprocessing.py /tmp/preprocessing_benchmark [--images=20] [--things=5,50] [--n-proc=1,2,4]
+        [--datasets=rugd,rellis] [--stages=createPanopticInstanceIds,createInstances] [--output=benchmark_results.json]
+        [--baseline=previous_results.json] [--tolerance=0.2] [--verbose]
+
+Synthetic colormap label images are generated at the RUGD (688x550) and RELLIS-3D (1920x1200)
+resolutions with the labels.py colors: horizontal stuff regions (sky, ground, vegetation...) and
+exactly --things non-touching thing instances per image. Every stage is then run on a fresh copy of
+the images for every --n-proc value, in its own process, and its per-image latency, throughput and
+peak memory (of the stage's main process and of its largest worker) are saved to the --output file.
+
+Stages: convertRugdToRellisFormat (RUGD only), createPanopticInstanceIds, createPanopticAnnotationsParallel,
+createInstances and createPanopticDataset. The _instanceIds.png inputs of createPanopticAnnotationsParallel
+and createInstances are created before they are timed.
+
+Pass --baseline with the results file of an earlier run to compare against it. Runs whose per-image
+latency grew by more than --tolerance (default 0.2, i.e. 20%) are reported and the script exits with status 1.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from labels import get_labels
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there
+    resource = None
+
+RESOLUTIONS = {
+    "rugd": (550, 688),
+    "rellis": (1200, 1920),
+}
+
+STAGES = [
+    "convertRugdToRellisFormat",
+    "createPanopticInstanceIds",
+    "createPanopticAnnotationsParallel",
+    "createInstances",
+    "createPanopticDataset",
+]
+
+# Stages that read the _instanceIds.png images instead of the colormaps
+INSTANCE_ID_STAGES = ["createPanopticAnnotationsParallel", "createInstances"]
+
+
+def generate_synthetic_colormap(height: int, width: int, n_things: int, is_rugd: bool, rng: np.random.Generator) -> tuple:
+    """
+    Return a synthetic colormap label image and the number of thing instances placed in it.
+    Thing instances are ellipses that don't touch each other, so each one is a separate instance.
+    """
+    labels = get_labels(is_rugd)
+    stuff_colors = [label.color for label in labels if not label.hasInstances and label.id != 0 and label.name != "sky"]
+    thing_colors = [label.color for label in labels if label.hasInstances]
+    sky_color = next(label.color for label in labels if label.name == "sky")
+
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    rows = np.arange(height)[:, None]
+    cols = np.arange(width)[None, :]
+
+    # Sky on top and wavy horizontal bands of stuff classes below it
+    image[:] = sky_color
+    top = int(height * rng.uniform(0.2, 0.4))
+    boundaries = np.sort(rng.uniform(top, height, size=rng.integers(3, 7)))
+    for boundary in np.concatenate([[top], boundaries]):
+        amplitude, period, phase = rng.uniform(2, height * 0.03), rng.uniform(width * 0.1, width), rng.uniform(0, 2 * np.pi)
+        wave = boundary + amplitude * np.sin(2 * np.pi * cols / period + phase)
+        image[rows >= wave] = stuff_colors[rng.integers(len(stuff_colors))]
+
+    # Stuff blobs (trees, bushes, rocks...) and a few void regions
+    for _ in range(rng.integers(5, 15)):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(width // 40, width // 8)), int(rng.integers(height // 40, height // 8)))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, stuff_colors[rng.integers(len(stuff_colors))], -1)
+    for _ in range(rng.integers(0, 4)):
+        x, y = int(rng.integers(width)), int(rng.integers(height))
+        image[y:y + int(rng.integers(2, height // 20)), x:x + int(rng.integers(2, width // 20))] = 0
+
+    # Thing instances, at least 2 pixels apart so they aren't merged into one instance
+    occupied = np.zeros((height, width), dtype=np.uint8)
+    kernel = np.ones((5, 5), dtype=np.uint8)
+    min_axis, max_axis = max(2, min(height, width) // 100), max(3, min(height, width) // 20)
+    n_placed = 0
+    for _ in range(n_things * 50):
+        if n_placed == n_things:
+            break
+        mask = np.zeros((height, width), dtype=np.uint8)
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(min_axis, max_axis)), int(rng.integers(min_axis, max_axis)))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+        if (mask & occupied).any():
+            continue
+
+        image[mask > 0] = thing_colors[rng.integers(len(thing_colors))]
+        occupied |= cv2.dilate(mask, kernel)
+        n_placed += 1
+
+    return image, n_placed
+
+
+def create_synthetic_dataset(data_dir: Path, n_images: int, height: int, width: int, n_things: int, is_rugd: bool, seed: int = 0) -> int:
+    """Save n_images synthetic colormaps in data_dir. Returns the total number of thing instances."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_instances = 0
+    for index in range(n_images):
+        image, n_placed = generate_synthetic_colormap(height, width, n_things, is_rugd, rng)
+        Image.fromarray(image).save(data_dir.joinpath(f"synthetic_{index:05d}.png"))
+        n_instances += n_placed
+    return n_instances
+
+
+def peak_rss_mb(who) -> float:
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def run_stage(stage: str, data_dir: str, dataset: str, n_proc: int):
+    is_rugd = dataset == "rugd"
+    if stage == "convertRugdToRellisFormat":
+        from convertRugdToRellisFormat import convert_labels_to_rellis
+        convert_labels_to_rellis(data_dir, n_proc)
+    elif stage == "createPanopticInstanceIds":
+        import createPanopticInstanceIds
+        createPanopticInstanceIds.main([data_dir, dataset, str(n_proc)])
+    elif stage == "createPanopticAnnotationsParallel":
+        from createPanopticAnnotationsParallel import generate_panoptic_images
+        generate_panoptic_images(data_dir, is_rugd, n_proc)
+    elif stage == "createInstances":
+        from createInstances import generatePanopticImages
+        generatePanopticImages(data_dir, is_rugd, n_proc)
+    elif stage == "createPanopticDataset":
+        from createPanopticDataset import generate_panoptic_dataset
+        generate_panoptic_dataset(data_dir, is_rugd, n_proc)
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+
+
+def _stage_process(stage: str, data_dir: str, dataset: str, n_proc: int, verbose: bool, connection):
+    # Runs in a fresh process, so the peak memory only covers this stage and its workers
+    try:
+        with open(os.devnull, "w") as devnull:
+            if verbose:
+                start = time.perf_counter()
+                run_stage(stage, data_dir, dataset, n_proc)
+            else:
+                with redirect_stdout(devnull), redirect_stderr(devnull):
+                    start = time.perf_counter()
+                    run_stage(stage, data_dir, dataset, n_proc)
+            seconds = time.perf_counter() - start
+
+        connection.send({
+            "seconds": seconds,
+            "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        })
+    except Exception as e:
+        connection.send({"error": repr(e)})
+
+
+def run_in_process(stage: str, data_dir: Path, dataset: str, n_proc: int, verbose: bool = False) -> dict:
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_stage_process, args=(stage, str(data_dir), dataset, n_proc, verbose, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(f"{stage} failed: {result['error']}")
+    return result
+
+
+def fresh_copy(source_dir: Path, run_root: Path) -> Path:
+    """Copy source_dir to run_root/labels/train, so the stages write their outputs inside run_root."""
+    if run_root.exists():
+        shutil.rmtree(run_root)
+    data_dir = run_root.joinpath("labels", "train")
+    shutil.copytree(source_dir, data_dir)
+    return data_dir
+
+
+def compare_results(results: list, baseline_file: str, tolerance: float) -> list:
+    """Return the runs whose per-image latency grew by more than tolerance compared to the baseline."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)["results"]
+
+    def key(result):
+        return (result["dataset"], result["things_per_image"], result["stage"], result["n_proc"])
+
+    baseline_latencies = {key(result): result["per_image_ms"] for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_latencies.get(key(result))
+        if old is None:
+            continue
+        change = result["per_image_ms"] / old - 1
+        print(f"{result['dataset']:7s} things={result['things_per_image']:<4d} {result['stage']:34s} n_proc={result['n_proc']:<3d} "
+              f"{old:9.1f} -> {result['per_image_ms']:9.1f} ms/image ({change:+.0%})")
+        if change > tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def run_benchmarks(work_dir: str, n_images: int, things: list, n_procs: list, datasets: list, stages: list, verbose: bool = False) -> list:
+    work_dir = Path(work_dir)
+    results = []
+    for dataset in datasets:
+        height, width = RESOLUTIONS[dataset]
+        for n_things in things:
+            print(f"Generating {n_images} synthetic {dataset} colormaps ({width}x{height}) with {n_things} thing instances each")
+            source_dir = work_dir.joinpath(f"{dataset}_{n_things}_things", "colormaps")
+            n_instances = create_synthetic_dataset(source_dir, n_images, height, width, n_things, dataset == "rugd")
+
+            instance_ids_dir = None
+            if any(stage in INSTANCE_ID_STAGES for stage in stages):
+                instance_ids_dir = fresh_copy(source_dir, work_dir.joinpath(f"{dataset}_{n_things}_things", "instance_ids"))
+                run_in_process("createPanopticInstanceIds", instance_ids_dir, dataset, os.cpu_count() or 1)
+
+            for stage in stages:
+                if stage == "convertRugdToRellisFormat" and dataset != "rugd":
+                    continue
+                for n_proc in n_procs:
+                    data_dir = fresh_copy(instance_ids_dir if stage in INSTANCE_ID_STAGES else source_dir, work_dir.joinpath("run"))
+                    run = run_in_process(stage, data_dir, dataset, n_proc, verbose)
+                    result = {
+                        "dataset": dataset,
+                        "width": width,
+                        "height": height,
+                        "images": n_images,
+                        "things_per_image": n_things,
+                        "instances": n_instances,
+                        "stage": stage,
+                        "n_proc": n_proc,
+                        "seconds": round(run["seconds"], 4),
+                        "per_image_ms": round(1000 * run["seconds"] / n_images, 2),
+                        "images_per_second": round(n_images / run["seconds"], 2),
+                        "peak_rss_mb": run["peak_rss_mb"],
+                        "peak_worker_rss_mb": run["peak_worker_rss_mb"],
+                    }
+                    results.append(result)
+                    print(f"  {stage:34s} n_proc={n_proc:<3d} {result['per_image_ms']:9.1f} ms/image "
+                          f"{result['images_per_second']:8.2f} images/s  peak RSS {result['peak_rss_mb']} MB "
+                          f"(largest worker {result['peak_worker_rss_mb']} MB)")
+
+    shutil.rmtree(work_dir.joinpath("run"), ignore_errors=True)
+    return results
+
+
+def main(args):
+    options = dict(arg[2:].split("=", 1) for arg in args if arg.startswith("--") and "=" in arg)
+    verbose = "--verbose" in args
+    args = [arg for arg in args if not arg.startswith("--")]
+
+    if len(args) < 1:
+        print("Please pass a working directory for the synthetic data")
+        exit()
+
+    work_dir = args[0]
+    n_images = int(options.get("images", 20))
+    things = [int(n) for n in options.get("things", "5,50").split(",")]
+    n_procs = [int(n) for n in options.get("n-proc", "1,2,4").split(",")]
+    datasets = options.get("datasets", "rugd,rellis").split(",")
+    stages = options.get("stages", ",".join(STAGES)).split(",")
+    output = options.get("output", "benchmark_results.json")
+
+    for stage in stages:
+        if stage not in STAGES:
+            print(f"Unknown stage {stage}, the stages are {', '.join(STAGES)}")
+            exit()
+
+    start = time.time()
+
+    results = run_benchmarks(work_dir, n_images, things, n_procs, datasets, stages, verbose)
+
+    with open(output, "w") as f:
+        json.dump({
+            "system": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            },
+            "results": results,
+        }, f, indent=4)
+    print(f"Saved the results to {output}")
+
+    end = time.time()
+    print(f"TOOK {end-start} SECONDS!")
+
+    if "baseline" in options:
+        regressions = compare_results(results, options["baseline"], float(options.get("tolerance", 0.2)))
+        if regressions:
+            print(f"{len(regressions)} runs are slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+"""
+Streaming writer for COCO annotation files.
+
+Images and annotations are written to temporary files as soon as they are added and
+stitched into the final file when the writer is closed, so a whole dataset never has
+to be held in memory. With indent=4 the output is identical to
+json.dump(data, f, sort_keys=True, indent=4). With compact=True entries are written
+without any whitespace, which makes the files much smaller and faster to load.
+"""
+
+import json
+import os
+import shutil
+
+
+def round_segmentation(annotation: dict, precision: int) -> dict:
+    """Round the polygon coordinates of an annotation to the given number of decimals."""
+    segmentation = annotation.get("segmentation")
+    if isinstance(segmentation, list):
+        annotation["segmentation"] = [[round(v, precision) for v in polygon] for polygon in segmentation]
+    return annotation
+
+
+class CocoJsonWriter:
+    def __init__(self, path, categories: list, compact: bool = False, precision: int = None):
+        self.path = str(path)
+        self.categories = categories
+        self.compact = compact
+        self.precision = precision
+        self.n_images = 0
+        self.n_annotations = 0
+
+        self._images_path = self.path + ".images.tmp"
+        self._annotations_path = self.path + ".annotations.tmp"
+        self._images = open(self._images_path, "w")
+        self._annotations = open(self._annotations_path, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
+
+    def _encode(self, entry, level: int) -> str:
+        if self.compact:
+            return json.dumps(entry, sort_keys=True, separators=(",", ":"))
+        prefix = " " * (4 * level)
+        return prefix + json.dumps(entry, sort_keys=True, indent=4).replace("\n", "\n" + prefix)
+
+    def _write_entry(self, f, entry, index: int):
+        if index > 0:
+            f.write("," if self.compact else ",\n")
+        f.write(self._encode(entry, level=2))
+
+    def add_image(self, image: dict):
+        self._write_entry(self._images, image, self.n_images)
+        self.n_images += 1
+
+    def add_annotation(self, annotation: dict):
+        if self.precision is not None:
+            annotation = round_segmentation(annotation, self.precision)
+        self._write_entry(self._annotations, annotation, self.n_annotations)
+        self.n_annotations += 1
+
+    def _write_list(self, f, key: str, tmp_file, n_entries: int, last: bool):
+        tmp_file.close()
+        if self.compact:
+            f.write(f'"{key}":[')
+        else:
+            f.write(f'    "{key}": [')
+            if n_entries > 0:
+                f.write("\n")
+
+        with open(tmp_file.name) as entries:
+            shutil.copyfileobj(entries, f)
+
+        if not self.compact and n_entries > 0:
+            f.write("\n    ")
+        f.write("]")
+        if not last:
+            f.write("," if self.compact else ",\n")
+
+    def close(self):
+        # Keys are written in sorted order to match json.dump(..., sort_keys=True)
+        with open(self.path, "w") as f:
+            f.write("{" if self.compact else "{\n")
+            self._write_list(f, "annotations", self._annotations, self.n_annotations, last=False)
+
+            if self.compact:
+                f.write(f'"categories":{self._encode(self.categories, level=0)},')
+            else:
+                f.write(f'    "categories": {self._encode(self.categories, level=1).lstrip()},\n')
+
+            self._write_list(f, "images", self._images, self.n_images, last=True)
+            f.write("}" if self.compact else "\n}")
+
+        self._discard()
+
+    def _discard(self):
+        for tmp_file in [self._images, self._annotations]:
+            tmp_file.close()
+            if os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
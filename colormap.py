@@ -0,0 +1,145 @@
+"""
+Helpers for decoding colormap label images.
+
+Colors are packed into a single 24-bit key (R << 16 | G << 8 | B) so a whole
+image can be resolved to label ids through a lookup table in one vectorized
+pass, instead of comparing every pixel against every label color.
+"""
+
+from functools import lru_cache
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+from labels import UNMATCHED_ID, get_conflict_colormap, get_label_registry
+
+
+def pack_color(color: tuple) -> int:
+    r, g, b = color
+    return (int(r) << 16) | (int(g) << 8) | int(b)
+
+
+def unpack_color(key: int) -> tuple:
+    return ((key >> 16) & 0xFF, (key >> 8) & 0xFF, key & 0xFF)
+
+
+def pack_colors(image: np.ndarray, bgr: bool = False) -> np.ndarray:
+    """
+    Pack an (H, W, 3+) image into an (H, W) uint32 array of color keys.
+    Set bgr=True for images read through cv2.imread. Alpha channels are ignored.
+    """
+    image = image[..., :3].astype(np.uint32)
+    if bgr:
+        b, g, r = image[..., 0], image[..., 1], image[..., 2]
+    else:
+        r, g, b = image[..., 0], image[..., 1], image[..., 2]
+    return (r << 16) | (g << 8) | b
+
+
+def get_color_lut(is_rugd: bool = True) -> np.ndarray:
+    """
+    Dense lookup table mapping every 24-bit color key to a label id, from the cached label registry.
+    Colors that don't belong to a label map to UNMATCHED_ID.
+    """
+    return get_label_registry(is_rugd).color_lut
+
+
+def _count_colors(keys: np.ndarray) -> Dict[tuple, int]:
+    colors, counts = np.unique(keys, return_counts=True)
+    return {unpack_color(int(key)): int(count) for key, count in zip(colors, counts)}
+
+
+def find_unmatched_colors(keys: np.ndarray, lut: np.ndarray) -> Dict[tuple, int]:
+    """Return {color: pixel count} for every color key that isn't in the lookup table."""
+    return _count_colors(keys[lut[keys] == UNMATCHED_ID])
+
+
+def colors_to_label_ids(image: np.ndarray, lut: np.ndarray, bgr: bool = False) -> tuple:
+    """
+    Map a colormap image to an (H, W) array of label ids.
+
+    Returns (label_ids, unmatched) where unmatched is a {color: pixel count} report
+    of colors that don't belong to any label. Those pixels are set to the void id (0).
+    """
+    keys = pack_colors(image, bgr)
+    label_ids = lut[keys]
+
+    unmatched = {}
+    unmatched_mask = label_ids == UNMATCHED_ID
+    if unmatched_mask.any():
+        unmatched = _count_colors(keys[unmatched_mask])
+        label_ids[unmatched_mask] = 0
+
+    return label_ids, unmatched
+
+
+def build_color_remap(colormap: Dict[tuple, tuple]) -> tuple:
+    """
+    Build the (input keys, output colors) table used by remap_colors from a {input color: output color} dict.
+    Input keys are sorted so pixels can be matched with a single searchsorted pass.
+    """
+    input_keys = np.array(sorted(pack_color(color) for color in colormap), dtype=np.uint32)
+    output_colors = np.array([colormap[unpack_color(int(key))] for key in input_keys], dtype=np.uint8).reshape(-1, 3)
+    return input_keys, output_colors
+
+
+@lru_cache(maxsize=None)
+def get_rugd_to_rellis_remap() -> tuple:
+    return build_color_remap(get_conflict_colormap())
+
+
+def remap_colors(image: np.ndarray, color_remap: tuple, bgr: bool = False) -> tuple:
+    """
+    Replace colors in one pass over the image.
+    Returns (image, n_changed). The input image is returned untouched if no pixel matched.
+    """
+    input_keys, output_colors = color_remap
+    if len(input_keys) == 0:
+        return image, 0
+
+    keys = pack_colors(image, bgr)
+    index = np.searchsorted(input_keys, keys).clip(max=len(input_keys) - 1)
+    matches = input_keys[index] == keys
+
+    n_changed = int(np.count_nonzero(matches))
+    if n_changed == 0:
+        return image, 0
+
+    if bgr:
+        output_colors = output_colors[:, ::-1]
+    image = image.copy()
+    image[..., :3][matches] = output_colors[index[matches]]
+    return image, n_changed
+
+
+def load_colormap(path, rugd_to_rellis: bool = False) -> np.ndarray:
+    """
+    Read a colormap label image as an RGB array.
+    With rugd_to_rellis, RUGD colors that differ from RELLIS-3D are converted in memory,
+    so the dataset doesn't need to be converted on disk with convertRugdToRellisFormat first.
+    """
+    image = np.array(Image.open(path))
+    if rugd_to_rellis:
+        image, _ = remap_colors(image, get_rugd_to_rellis_remap())
+    return image
+
+
+def merge_unmatched_reports(reports) -> Dict[tuple, int]:
+    merged = {}
+    for report in reports:
+        for color, count in report.items():
+            merged[color] = merged.get(color, 0) + count
+    return merged
+
+
+def print_unmatched_report(unmatched: Dict[tuple, int], n_files: int = None):
+    if not unmatched:
+        return
+
+    header = f"{len(unmatched)} colors did not match any label"
+    if n_files is not None:
+        header += f" (in {n_files} files)"
+    print(header)
+    for color, count in sorted(unmatched.items(), key=lambda item: -item[1]):
+        print(f"    {color}: {count} pixels")
@@ -1,40 +1,64 @@
 import time
-from multiprocessing import Pool
-from pathlib import Path
 
 import cv2
-import numpy as np
-import parallelbar
 
-from labels import get_conflict_colormap
+from colormap import (
+    find_unmatched_colors,
+    get_color_lut,
+    get_rugd_to_rellis_remap,
+    merge_unmatched_reports,
+    pack_colors,
+    print_unmatched_report,
+    remap_colors,
+)
+from executor import parallel_imap
+from labels import get_label_registry
+from labelstore import GENERATED_DIRS, GENERATED_FILES, PngStore
+from splits import iter_label_files
 
 
-def _replace_label_colors(args: tuple) -> str:
-    label_path, conflict_colormap = args
+def _replace_label_colors(args) -> tuple:
+    label_path, png_store = args
     label_path_str = str(label_path)
 
+    # cv2 reads images as BGR, so colors are compared as packed RGB keys
     image = cv2.imread(label_path_str)
-    for input_color, output_color in conflict_colormap.items():
-        image[np.all(image == input_color, axis=-1)] = output_color
-    
-    cv2.imwrite(label_path_str, image)
-    return label_path_str
+    image, n_changed = remap_colors(image, get_rugd_to_rellis_remap(), bgr=True)
+    # Checked after the conversion, so files converted by a previous run report no RELLIS-3D color
+    unmatched = find_unmatched_colors(pack_colors(image, bgr=True), get_color_lut(is_rugd=False))
 
+    # Only rewrite the files that contain RUGD specific colors
+    if n_changed > 0:
+        png_store.save(label_path_str[:-len(png_store.ext)], image, bgr=True)
+    return label_path_str, n_changed > 0, unmatched
 
-def convert_labels_to_rellis(labels_path: str, n_proc: int = 1):
+
+def convert_labels_to_rellis(labels_path: str, n_proc: int = 1, png_level: int = None):
+    """
+    Convert RUGD colormap labels to the RELLIS-3D colors on disk. labels_path is a labels directory
+    or a split manifest (see splits.py).
+    The conversion can also be done in memory while decoding the labels
+    (see colormap.load_colormap), which avoids rewriting the dataset.
+    png_level is the zlib compression level (0-9) of the rewritten files, OpenCV's default if None.
+    """
     start = time.time()
-    label_images = list(Path(labels_path).glob("**/*.png"))
-    conflict_colormap = get_conflict_colormap()
-
-    with Pool():
-        results = parallelbar.progress_imap(
-            func=_replace_label_colors,
-            tasks=[(label_image, conflict_colormap) for label_image in label_images],
-            n_cpu=n_proc,
-            chunk_size=10,
-        )
-        print()
-        print(f"{len(results)} files converted")
+    # The labels are listed while the workers convert the first ones, skipping the images
+    # generated by the other stages
+    label_images = iter_label_files(labels_path, exclude_suffixes=GENERATED_FILES, exclude_dirs=GENERATED_DIRS)
+
+    results = list(parallel_imap(
+        _replace_label_colors,
+        ((label_image, PngStore(png_level)) for _, label_image in label_images),
+        n_proc,
+        initializer=get_label_registry,
+        initargs=(False,),
+        desc="Converting Labels",
+    ))
+    n_converted = sum(changed for _, changed, _ in results)
+    print(f"{n_converted} files converted, {len(results) - n_converted} files already matched RELLIS-3D colors")
+
+    unmatched_reports = [unmatched for _, _, unmatched in results if unmatched]
+    print_unmatched_report(merge_unmatched_reports(unmatched_reports), len(unmatched_reports))
 
     end = time.time()
     print(f"TOOK {end - start} SECONDS!")
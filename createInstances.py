@@ -8,150 +8,223 @@ Usage Example:
 This script will generate _panoptic.png images from _instanceIds.png images.
 The generated _panoptic.png image is saved in teh same directory where _instanceIds.png lives.
 Moreover, this script also generates an annotations JSON file in COCO format.
+Pass --compact to write the JSON file without indentation and --precision=N to round
+the polygon coordinates to N decimals. Pass --rle to write COCO RLE segmentations instead of
+polygons; they are exact, smaller for fragmented masks, and need cfg.INPUT.MASK_FORMAT = "bitmask"
+to train with detectron2.
+
+Processed images are recorded in a manifest next to the JSON file. When the script is run
+again, only new or changed images are processed and the JSON file is patched with their entries.
 """
 
 import json
-import pathlib
 import sys
 import time
 
 import numpy as np
-from PIL import Image
 from shapely.geometry import Polygon
 from skimage import measure
-from tqdm.auto import tqdm
-
-from labels import get_id2labels, get_labels
-
-
-def generatePanopticImages(dataPath, is_rugd: bool = True):
 
-    categories, instance_categories = [], []
-    dataPath = pathlib.Path(dataPath)
+from cocojson import CocoJsonWriter
+from labels import LabelRegistry, get_categories, get_label_registry, get_labels_version
+from labelstore import INSTANCE_IDS_FILES, load_label, strip_label_suffix
+from manifest import StageManifest, load_coco_entries
+from scriptargs import split_args
+from segments import get_segment_stats
+from splits import get_data_path, iter_label_files
+
+
+def get_polygons(mask: np.ndarray, offset: tuple = (0, 0)) -> list:
+    """offset is the (x, y) position of the mask in the full image."""
+    contours = measure.find_contours(mask, 0.5, positive_orientation="low")
+    segmentations = list()
+    for contour in contours:
+        if len(contour) < 3:
+            continue
+        # Flip from (row, col) representation to (x, y), move it to its place
+        # in the full image and subtract the padding pixel
+        contour = contour[:, ::-1] + np.array(offset) - 1
+
+        # Make a polygon and simplify it
+        poly = Polygon(contour)
+        poly = poly.simplify(1.0, preserve_topology=False)
+        if not isinstance(poly, Polygon):
+            seg = [np.array(x.exterior.coords).ravel().tolist() for x in poly.geoms]
+            segmentations.extend(seg)
+        else:
+            seg = np.array(poly.exterior.coords).ravel().tolist()
+            segmentations.append(seg)
+
+    return segmentations
+
+
+def rle_to_string(counts: list) -> str:
+    """Compress RLE counts into a COCO counts string, like pycocotools' rleToString."""
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def get_rles(instance_ids: np.ndarray, segment_ids: np.ndarray) -> list:
+    """
+    COCO RLE segmentations ({"size": [h, w], "counts": str}) of the given segments.
+    The runs of all segments are found with one pass over the column-major image.
+    """
+    height, width = instance_ids.shape
+    flat = instance_ids.ravel(order="F")
+    run_starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    run_ends = np.append(run_starts[1:], flat.size)
+    run_values = flat[run_starts]
+
+    # Group the runs by segment, keeping them in image order within a segment
+    selected = np.flatnonzero(np.isin(run_values, segment_ids))
+    selected = selected[np.argsort(run_values[selected], kind="stable")]
+    values = run_values[selected]
+    bounds = np.searchsorted(values, segment_ids, side="left"), np.searchsorted(values, segment_ids, side="right")
+
+    rles = []
+    for first, last in zip(*bounds):
+        starts = run_starts[selected[first:last]]
+        ends = run_ends[selected[first:last]]
+        # Counts alternate between background and segment runs, starting with background
+        counts = np.empty(2 * len(starts) + 1, dtype=np.int64)
+        counts[0:-1:2] = starts - np.concatenate(([0], ends[:-1]))
+        counts[1::2] = ends - starts
+        counts[-1] = flat.size - (ends[-1] if len(ends) else 0)
+        rles.append({"size": [height, width], "counts": rle_to_string(counts.tolist())})
+
+    return rles
+
+
+def get_instance_annotations(instance_ids: np.ndarray, registry: LabelRegistry, stats: tuple = None, rle: bool = False) -> list:
+    """
+    Create the COCO instance annotations of every thing segment in an instance id image.
+    The "id" and "image_id" fields are left for the caller to assign.
+    stats are the get_segment_stats of instance_ids, if they were already computed.
+    With rle=True the segmentations are COCO RLE instead of polygons.
+    """
+    if stats is None:
+        stats = get_segment_stats(instance_ids)
+    segment_ids, _, areas, bboxes = stats
+
+    # Select the thing segments with one lookup instead of checking every segment's label
+    label_ids = registry.instance_to_label[segment_ids]
+    things = registry.isthing[label_ids]
+    if rle:
+        rles = iter(get_rles(instance_ids, segment_ids[things]))
 
-    categories_file = dataPath.parent.joinpath(f"categories.json")
+    annotations = []
+    for seg_id, label_id, area, bbox in zip(segment_ids[things].tolist(), label_ids[things].tolist(), areas[things].tolist(), bboxes[things].tolist()):
+        if rle:
+            segmentations = next(rles)
+        else:
+            # Trace contours on the bounding box (plus a 1 pixel margin) instead of the full image
+            x, y, width, height = bbox
+            x0, y0 = max(x - 1, 0), max(y - 1, 0)
+            mask = instance_ids[y0:y + height + 1, x0:x + width + 1] == seg_id
+            segmentations = get_polygons(mask, offset=(x0, y0))
+            if len(segmentations) == 0:
+                continue
 
-    for label in get_labels(is_rugd):
-        category = {
-            "id": int(label.id),
-            "name": label.name,
-            "color": label.color,
-            "supercategory": label.category,
-            "isthing": 1 if label.hasInstances else 0
-        }
+        annotations.append({
+            "category_id": label_id,
+            "segmentation": segmentations,
+            "area": area,
+            "bbox": bbox,
+            "bbox_mode": 1, # XYWH_ABS=1 see https://detectron2.readthedocs.io/en/latest/modules/structures.html
+            "iscrowd": 0
+        })
 
-        if label.hasInstances:
-            instance_categories.append(category)
-        categories.append(category)
+    return annotations
 
-    with open(categories_file, "w") as f:
-        json.dump(categories, f, indent=4)
 
+def generate_instance_annotations(args) -> tuple:
+    filepath, index, is_rugd, rle = args
+    original_format = load_label(filepath)
+    input_filename = strip_label_suffix(filepath.name) + ".jpg"
 
-    images = []
-    annotations = []
-    id2labels = get_id2labels(is_rugd)
-
-    files = list(pathlib.Path(dataPath).glob("**/*_instanceIds.png"))
-    annotId = 0
-    imageId = 0
-    for f in tqdm(files, desc="Generating Panoptic Images"):
-
-        originalFormat = np.array(Image.open(f))
-        inputFileName = f.name.replace("_instanceIds.png", ".jpg")
-
-        # image entry, id for image is its filename without extension
-        images.append({
-            "id": imageId,
-            "width": int(originalFormat.shape[1]),
-            "height": int(originalFormat.shape[0]),
-            "file_name": inputFileName
-        })
+    image_entry = {
+        "id": index,
+        "width": int(original_format.shape[1]),
+        "height": int(original_format.shape[0]),
+        "file_name": input_filename
+    }
+    annotations = get_instance_annotations(original_format, get_label_registry(is_rugd), rle=rle)
+    for annotation in annotations:
+        annotation["image_id"] = index
 
-        segmentIds = np.unique(originalFormat)
+    return image_entry, annotations
 
-        for segmentId in segmentIds:
-            if segmentId == 0:
-              continue 
-            labelId = segmentId
-            if labelId > 1000:
-                labelId = segmentId // 1000
 
-            labelInfo = id2labels[labelId]
+def generatePanopticImages(dataPath, is_rugd: bool = True, n_proc: int = 1, compact: bool = False, precision: int = None, rle: bool = False):
 
-            if not labelInfo.hasInstances:
-                continue
+    inputPath = dataPath
+    dataPath = get_data_path(dataPath)
 
-            isCrowd = 0
-
-            mask = originalFormat == segmentId
-
-            contours = measure.find_contours(mask, 0.5, positive_orientation="low")
-            segmentations = list()
-            if labelInfo.hasInstances:
-                for contour in contours:
-                    if len(contour) < 3:
-                        continue
-                    # Flip from (row, col) representation to (x, y)
-                    # and subtract the padding pixel
-                    for i in range(len(contour)):
-                        row, col = contour[i]
-                        contour[i] = (col - 1, row - 1)
-
-                    # Make a polygon and simplify it
-                    poly = Polygon(contour)
-                    poly = poly.simplify(1.0, preserve_topology=False)
-                    if not isinstance(poly, Polygon):
-                        seg = [np.array(x.exterior.coords).ravel().tolist() for x in poly.geoms]
-                        segmentations.extend(seg)
-                    else:
-                        seg = np.array(poly.exterior.coords).ravel().tolist()
-                        segmentations.append(seg)
+    categories_file = dataPath.parent.joinpath(f"categories.json")
 
-            if len(segmentations) == 0:
-                continue
+    categories = get_categories(is_rugd)
+    instance_categories = [category for category in categories if category["isthing"]]
 
-            area = np.sum(mask) # segment area computation
-
-            # bbox computation for a segment
-            hor = np.sum(mask, axis=0)
-            hor_idx = np.nonzero(hor)[0]
-            x = hor_idx[0]
-            width = hor_idx[-1] - x + 1
-            vert = np.sum(mask, axis=1)
-            vert_idx = np.nonzero(vert)[0]
-            y = vert_idx[0]
-            height = vert_idx[-1] - y + 1
-            bbox = [int(x), int(y), int(width), int(height)]
-
-            annotations.append({
-                "id": annotId,
-                "image_id": imageId,
-                "category_id": int(labelInfo.id),
-                "segmentation": segmentations,
-                "area": int(area),
-                "bbox": bbox,
-                "bbox_mode": 1, # XYWH_ABS=1 see https://detectron2.readthedocs.io/en/latest/modules/structures.html
-                "iscrowd": isCrowd
-            })
-
-            annotId += 1
-        imageId += 1
+    with open(categories_file, "w") as f:
+        json.dump(categories, f, indent=4)
 
     annotations_file = dataPath.parent.joinpath(f"annotations_{dataPath.name}_instances.json")
-    print("\nSaving the json file {}".format(annotations_file))
-
-    annotation_data = {
-        "images": images,
-        "annotations": annotations,
-        "categories": instance_categories
-    }
-
-    with open(annotations_file, "w") as f:
-        json.dump(annotation_data, f, sort_keys=True, indent=4)
 
+    # Only process images that are new, changed or were processed with different labels.
+    # Entries of the other images are copied over from the existing json file.
+    # Image ids are kept in the manifest and assigned in the order the files are listed, so they
+    # don't change across reruns or with the number of processes.
+    existing_entries = load_coco_entries(annotations_file)
+    # Switching the segmentation format reprocesses every image
+    labels_version = get_labels_version(is_rugd) + (":rle" if rle else "")
+    manifest = StageManifest(dataPath.parent.joinpath(f"manifest_{dataPath.name}_instances.json"), labels_version)
+
+    print("Saving the json file {}".format(annotations_file))
+
+    # Entries are streamed to the json file as the workers return them, and the label files are
+    # listed while the workers process the first ones
+    with CocoJsonWriter(annotations_file, instance_categories, compact, precision) as writer:
+        def add_entries(image_entry, annotations):
+            writer.add_image(image_entry)
+            for annotation in annotations:
+                annotation["id"] = writer.n_annotations
+                writer.add_annotation(annotation)
+
+        def add_result(result):
+            add_entries(*result)
+            return []
+
+        manifest.process(
+            iter_label_files(inputPath, INSTANCE_IDS_FILES),
+            generate_instance_annotations,
+            lambda filepath, image_id: (filepath, image_id, is_rugd, rle),
+            add_result,
+            lambda image_id: add_entries(*existing_entries[image_id]),
+            existing_entries.keys(),
+            n_proc,
+            initializer=get_label_registry, initargs=(is_rugd,), desc="Generating Instance Annotations",
+        )
 
 def main(args):
+    args, options = split_args(args)
+    compact = "--compact" in options
+    rle = "--rle" in options
+    precision = None
+    for arg in options:
+        if arg.startswith("--precision="):
+            precision = int(arg.split("=")[1])
+
     if len(args) < 1:
         print("Please pass directory path")
         exit()
@@ -163,9 +236,16 @@ def main(args):
         if args[1] == "rellis":
             is_rugd = False
 
+    n_proc = 1
+    if len(args) > 2:
+        try:
+            n_proc = int(args[2])
+        except:
+            pass
+
     start = time.time()
 
-    generatePanopticImages(input_dir, is_rugd)
+    generatePanopticImages(input_dir, is_rugd, n_proc, compact, precision, rle)
 
     end = time.time()
     print(f"TOOK {end-start} SECONDS!")
@@ -8,73 +8,49 @@ Usage Example:
 This script will generate _panoptic.png images from _instanceIds.png images.
 The generated _panoptic.png image is saved in teh same directory where _instanceIds.png lives.
 Moreover, this script also generates an annotations JSON file in COCO format.
+Pass --compact to write the JSON file without indentation.
+Pass --semantic to also write the semantic segmentation images (thing pixels set to 183) to <name>_semantic/.
+The per-category pixel and instance counts, instance size histograms and class weights are saved
+to stats.json in the same directory as the JSON file (see labelstats.py).
+The instance ids can be stored in any labelstore.py format; --png-level=N sets the zlib compression
+level (0-9) of the written png images.
+
+Processed images are recorded in a manifest next to the JSON file. When the script is run
+again, only new or changed images are processed and the JSON file is patched with their entries.
 """
 
-import json
 import os
 import sys
 import time
-from multiprocessing import Pool
-from pathlib import Path
 
-import cv2
-import numpy as np
-import parallelbar
-from PIL import Image
-
-from labels import get_labels
+from cocojson import CocoJsonWriter
+from labels import get_categories, get_label_registry, get_labels_version
+from labelstats import LabelStats, get_image_stats
+from labelstore import INSTANCE_IDS_FILES, PNG_ARTIFACT_LEVEL, PngStore, load_label, strip_label_suffix
+from manifest import StageManifest, load_coco_entries
+from scriptargs import split_args
+from segments import generate_panoptic_segments, get_label_category_to_semantic, get_segment_stats, get_semantic_image
+from splits import get_data_path, iter_label_files
 
 
 def generate_panoptic_image(args) -> tuple:
-    filepath, out_dir, index = args
-    original_format = np.array(cv2.imread(str(filepath), flags=-1), dtype=np.uint16)
-    input_filename = filepath.name.replace("_instanceIds.png", ".png")
-    output_filepath = str(out_dir.joinpath(input_filename))
+    filepath, out_dir, index, semantic_dir, is_rugd, png_level = args
+    png_store = PngStore(png_level)
+    original_format = load_label(filepath)
+    name = strip_label_suffix(filepath.name)
+    input_filename = name + ".png"
 
     y_dim, x_dim = original_format.shape[0:2]
-    pan_format = np.zeros((y_dim, x_dim, 3), dtype=np.uint8)
-
-    segment_ids = np.unique(original_format)
-    segments_info = []
-    for seg_id in segment_ids:
-        if seg_id == 0:
-            continue
-
-        label_id = seg_id
-        if label_id >= 1000:
-            label_id //= 1000
-        
-        mask = original_format == seg_id
-        new_color = (seg_id % 256, seg_id // 256, seg_id // 65536) # 65536 = 256^2
-        pan_format[mask] = new_color
-
-        # Segment area computation
-        area = int(np.sum(mask))
-
-        # Bounding-box computation
-        horizontal = np.sum(mask, axis=0)
-        horizontal_index = np.nonzero(horizontal)[0]
-        x = horizontal_index[0]
-        width = horizontal_index[-1] - x + 1
-
-        vertical = np.sum(mask, axis=1)
-        vertical_index = np.nonzero(vertical)[0]
-        y = vertical_index[0]
-        height = vertical_index[-1] - y + 1
-
-        bbox = [int(x), int(y), int(width), int(height)]
-
-        segments_info.append({
-            "id": int(seg_id),
-            "category_id": int(label_id),
-            "area": area,
-            "bbox": bbox,
-            "bbox_mode": 1, # XYWH_ABS=1 see https://detectron2.readthedocs.io/en/latest/modules/structures.html
-            "iscrowd": 0
-        })
-
-    Image.fromarray(pan_format).save(output_filepath)
-    
+    stats = get_segment_stats(original_format)
+    pan_format, segments_info = generate_panoptic_segments(original_format, stats)
+
+    png_store.save(out_dir.joinpath(name), pan_format)
+
+    # Write the semantic image from the same instance ids instead of re-reading the panoptic png later
+    if semantic_dir is not None:
+        semantic = get_semantic_image(original_format, get_label_category_to_semantic(is_rugd), get_label_registry(is_rugd).instance_to_label)
+        png_store.save(semantic_dir.joinpath(name), semantic)
+
     image_entry = {
         "id": index,
         "width": x_dim,
@@ -88,55 +64,83 @@ def generate_panoptic_image(args) -> tuple:
         "segments_info": segments_info,
     }
 
-    return (image_entry, annotation_entry)
+    _, category_ids, areas, _ = stats
+    image_stats = get_image_stats(category_ids, areas, original_format.size, get_label_registry(is_rugd).isthing)
+
+    return (image_entry, annotation_entry, image_stats)
 
 
-def generate_panoptic_images(input_dir: str, is_rugd: bool = True, n_proc: int = 1):
+def generate_panoptic_images(input_dir: str, is_rugd: bool = True, n_proc: int = 1, compact: bool = False, semantic: bool = False,
+                             png_level: int = PNG_ARTIFACT_LEVEL):
     # Generate Categories
-    categories = []
-    for label in get_labels(is_rugd):
-        if label.id != 0:
-            categories.append({
-                'id': int(label.id),
-                'name': label.name,
-                'color': label.color,
-                'supercategory': label.category,
-                'isthing': 1 if label.hasInstances else 0
-            })
-
-    data_path = Path(input_dir)
+    all_categories = get_categories(is_rugd)
+    categories = [category for category in all_categories if category["id"] != 0]
+
+    data_path = get_data_path(input_dir)
     annotations_file = data_path.parent.joinpath(f'annotations_{data_path.name}_panoptic.json')
+    stats_file = data_path.parent.joinpath("stats.json")
     out_dir = data_path.parent.joinpath(f"{data_path.name}_panoptic")
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    else:
-        print(f"Directory {str(out_dir)} already exists. Please delete and try again.")
-        exit()
 
-    input_files = list(Path(data_path).glob("**/*_instanceIds.png"))
-    
-    results = []
-    with Pool():
-        results = parallelbar.progress_imap(
-            func=generate_panoptic_image,
-            tasks=[(input_file, out_dir, index) for index, input_file in enumerate(input_files)],
-            n_cpu=n_proc,
-            chunk_size=1,
+    semantic_dir = None
+    if semantic:
+        semantic_dir = data_path.parent.joinpath(f"{data_path.name}_semantic")
+        if not os.path.exists(semantic_dir):
+            os.mkdir(semantic_dir)
+
+    # Only process images that are new, changed or were processed with different labels.
+    # Entries of the other images are copied over from the existing json file.
+    existing_entries = load_coco_entries(annotations_file)
+    # Switching --semantic on or off reprocesses every image, so the semantic images are written
+    labels_version = get_labels_version(is_rugd) + (":semantic" if semantic else "")
+    manifest = StageManifest(data_path.parent.joinpath(f"manifest_{data_path.name}_panoptic.json"), labels_version)
+
+    # Entries are streamed to the json file as the workers return them, and the label files are
+    # listed while the workers process the first ones
+    print("Saving the json file {}".format(annotations_file))
+    label_stats = LabelStats(get_label_registry(is_rugd).isthing)
+    with CocoJsonWriter(annotations_file, categories, compact) as writer:
+        def add_entries(image_entry, annotation_entries):
+            writer.add_image(image_entry)
+            for annotation_entry in annotation_entries:
+                writer.add_annotation(annotation_entry)
+                label_stats.add_segments_info(image_entry, annotation_entry["segments_info"])
+
+        def add_result(result):
+            image_entry, annotation_entry, image_stats = result
+            label_stats.add(image_stats)
+            writer.add_image(image_entry)
+            writer.add_annotation(annotation_entry)
+            outputs = [out_dir.joinpath(annotation_entry["file_name"])]
+            if semantic:
+                outputs.append(semantic_dir.joinpath(annotation_entry["file_name"]))
+            return outputs
+
+        manifest.process(
+            iter_label_files(input_dir, INSTANCE_IDS_FILES),
+            generate_panoptic_image,
+            lambda filepath, image_id: (filepath, out_dir, image_id, semantic_dir, is_rugd, png_level),
+            add_result,
+            lambda image_id: add_entries(*existing_entries[image_id]),
+            existing_entries.keys(),
+            n_proc,
+            initializer=get_label_registry, initargs=(is_rugd,), desc="Generating Panoptic Images",
         )
 
-    images, annotations = zip(*results)
-    
-    print("\nSaving the json file {}".format(annotations_file))
-    annotation_data = {
-        "images": images,
-        "annotations": annotations,
-        "categories": categories
-    }
-    with open(annotations_file, "w") as f:
-        json.dump(annotation_data, f, sort_keys=True, indent=4)
+    print("Saving the class statistics {}".format(stats_file))
+    label_stats.save(stats_file, data_path.name, all_categories)
 
 
 def main(args):
+    args, options = split_args(args)
+    compact = "--compact" in options
+    semantic = "--semantic" in options
+    png_level = PNG_ARTIFACT_LEVEL
+    for arg in options:
+        if arg.startswith("--png-level="):
+            png_level = int(arg.split("=")[1])
+
     if len(args) < 1:
         print("Please pass directory path")
         exit()
@@ -157,7 +161,7 @@ def main(args):
 
     start = time.time()
 
-    generate_panoptic_images(input_dir, is_rugd, n_proc)
+    generate_panoptic_images(input_dir, is_rugd, n_proc, compact, semantic, png_level)
 
     end = time.time()
     print(f"TOOK {end-start} SECONDS!")
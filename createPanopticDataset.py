@@ -0,0 +1,238 @@
+"""
+Fused preprocessing pipeline that decodes each colormap label image only once.
+
+Usage Example:
+    python createPanopticDataset.py /path/to/labels/train rellis 8 [--save-instance-ids] [--compact] [--precision=N] [--rle] [--label-format=npy] [--png-level=N]
+
+For every colormap image in the input directory, a single worker creates
+    - the panoptic png in <input_dir>_panoptic/ and its segments_info
+    - the COCO instance annotations (polygons, or RLE with --rle) of its thing segments
+    - the semantic png in <input_dir>_semantic/ (thing pixels are set to 183, like panopticapi's --things_other)
+    - optionally, the _instanceIds.png intermediate next to the input image (or .npy/.npz with
+      --label-format=npy/npz, see labelstore.py)
+
+The outputs replace running createPanopticInstanceIds.py, createPanopticAnnotationsParallel.py,
+createInstances.py and panopticapi's panoptic2semantic_segmentation.py one after the other.
+The annotations_<name>_panoptic.json, annotations_<name>_instances.json and categories.json
+files are saved in the parent directory of the input directory. They are streamed to disk as the
+workers return their results; pass --compact to write them without indentation and --precision=N
+to round the polygon coordinates to N decimals. Pass --rle to write COCO RLE segmentations
+instead of polygons (train with cfg.INPUT.MASK_FORMAT = "bitmask").
+
+Pass "rellis" as the second argument for RELLIS-3D labels, or "rugd_to_rellis" to convert RUGD
+label colors to RELLIS-3D colors in memory instead of running convertRugdToRellisFormat first.
+
+--png-level=N sets the zlib compression level (0-9) of the panoptic and semantic png images.
+
+The per-category pixel and instance counts, instance size histograms and class weights of the
+split are saved to stats.json next to categories.json (see labelstats.py).
+
+Processed images are recorded in manifest_<name>_dataset.json. When the script is run again,
+only new or changed images are processed and the JSON files are patched with their entries.
+"""
+
+import json
+import os
+import sys
+import time
+
+from cocojson import CocoJsonWriter
+from colormap import colors_to_label_ids, load_colormap, merge_unmatched_reports, print_unmatched_report
+from components import label_instances
+from createInstances import get_instance_annotations
+from labels import get_categories, get_label_registry, get_labels_version
+from labelstats import LabelStats, get_image_stats
+from labelstore import GENERATED_DIRS, GENERATED_FILES, INSTANCE_IDS_SUFFIX, PNG_ARTIFACT_LEVEL, PngStore, get_label_store
+from manifest import StageManifest, load_coco_entries
+from scriptargs import split_args
+from segments import generate_panoptic_segments, get_label_category_to_semantic, get_segment_stats, get_semantic_image
+from splits import get_data_path, iter_label_files
+
+
+def process_colormap_image(args) -> tuple:
+    filepath, panoptic_dir, semantic_dir, index, is_rugd, rugd_to_rellis, instance_ids_store, png_level, rle = args
+    registry = get_label_registry(is_rugd)
+    png_store = PngStore(png_level)
+
+    image = load_colormap(filepath, rugd_to_rellis)
+    label_ids, unmatched = colors_to_label_ids(image, registry.color_lut)
+    instance_ids = label_instances(label_ids, registry.isthing)
+
+    outputs = []
+    if instance_ids_store is not None:
+        outputs.append(instance_ids_store.save(str(filepath).replace(".png", "") + INSTANCE_IDS_SUFFIX, instance_ids))
+
+    # The segment statistics are shared by the panoptic and instance annotations
+    stats = get_segment_stats(instance_ids)
+    pan_format, segments_info = generate_panoptic_segments(instance_ids, stats)
+    outputs.append(png_store.save(panoptic_dir.joinpath(filepath.stem), pan_format))
+
+    semantic = get_semantic_image(instance_ids, get_label_category_to_semantic(is_rugd), registry.instance_to_label)
+    outputs.append(png_store.save(semantic_dir.joinpath(filepath.stem), semantic))
+
+    y_dim, x_dim = instance_ids.shape
+    panoptic_image_entry = {
+        "id": index,
+        "width": x_dim,
+        "height": y_dim,
+        "file_name": filepath.name,
+    }
+    panoptic_annotation_entry = {
+        "image_id": index,
+        "id": index,
+        "file_name": filepath.name,
+        "segments_info": segments_info,
+    }
+    instance_image_entry = dict(panoptic_image_entry, file_name=filepath.name.replace(".png", ".jpg"))
+    instance_annotations = get_instance_annotations(instance_ids, registry, stats, rle)
+
+    _, category_ids, areas, _ = stats
+    image_stats = get_image_stats(category_ids, areas, instance_ids.size, registry.isthing)
+
+    return (panoptic_image_entry, panoptic_annotation_entry, instance_image_entry, instance_annotations, unmatched, image_stats, outputs)
+
+
+def generate_panoptic_dataset(
+    input_dir: str,
+    is_rugd: bool = True,
+    n_proc: int = 1,
+    save_instance_ids: bool = False,
+    compact: bool = False,
+    precision: int = None,
+    rugd_to_rellis: bool = False,
+    rle: bool = False,
+    instance_ids_store=None,
+    png_level: int = PNG_ARTIFACT_LEVEL,
+):
+    """instance_ids_store is the labelstore store of the saved instance id images, png by default."""
+    if instance_ids_store is None:
+        instance_ids_store = get_label_store()
+    categories = get_categories(is_rugd)
+    panoptic_categories = [category for category in categories if category["id"] != 0]
+    instance_categories = [category for category in categories if category["isthing"]]
+
+    data_path = get_data_path(input_dir)
+    panoptic_file = data_path.parent.joinpath(f"annotations_{data_path.name}_panoptic.json")
+    instances_file = data_path.parent.joinpath(f"annotations_{data_path.name}_instances.json")
+    categories_file = data_path.parent.joinpath("categories.json")
+    stats_file = data_path.parent.joinpath("stats.json")
+    panoptic_dir = data_path.parent.joinpath(f"{data_path.name}_panoptic")
+    semantic_dir = data_path.parent.joinpath(f"{data_path.name}_semantic")
+
+    for out_dir in [panoptic_dir, semantic_dir]:
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+
+    # Only process images that are new, changed or were processed with different labels.
+    # Entries of the other images are copied over from the existing json files.
+    existing_panoptic = load_coco_entries(panoptic_file)
+    existing_instances = load_coco_entries(instances_file)
+    # Switching the segmentation or storage format reprocesses every image
+    labels_version = get_labels_version(is_rugd) + (":rle" if rle else "")
+    # Saving the instance ids (in any format) reprocesses every image, so the files are written
+    if save_instance_ids:
+        labels_version += f":{instance_ids_store}"
+    manifest = StageManifest(data_path.parent.joinpath(f"manifest_{data_path.name}_dataset.json"), labels_version)
+
+    print("Saving the json file {}".format(categories_file))
+    with open(categories_file, "w") as f:
+        json.dump(categories, f, indent=4)
+
+    # Entries are streamed to the json files as the workers return them
+    print("Saving the json files {} and {}".format(panoptic_file, instances_file))
+    unmatched_reports = []
+    label_stats = LabelStats(get_label_registry(is_rugd).isthing)
+    with CocoJsonWriter(panoptic_file, panoptic_categories, compact) as panoptic_writer, \
+            CocoJsonWriter(instances_file, instance_categories, compact, precision) as instances_writer:
+        def add_instances(instance_image, annotations):
+            instances_writer.add_image(instance_image)
+            for annotation in annotations:
+                annotation["id"] = instances_writer.n_annotations
+                annotation["image_id"] = instance_image["id"]
+                instances_writer.add_annotation(annotation)
+
+        def add_result(result):
+            panoptic_image, panoptic_annotation, instance_image, annotations, unmatched, image_stats, outputs = result
+            label_stats.add(image_stats)
+            panoptic_writer.add_image(panoptic_image)
+            panoptic_writer.add_annotation(panoptic_annotation)
+            add_instances(instance_image, annotations)
+            if unmatched:
+                unmatched_reports.append(unmatched)
+            return outputs
+
+        def add_unchanged(image_id):
+            panoptic_image, panoptic_annotations = existing_panoptic[image_id]
+            panoptic_writer.add_image(panoptic_image)
+            for panoptic_annotation in panoptic_annotations:
+                panoptic_writer.add_annotation(panoptic_annotation)
+                label_stats.add_segments_info(panoptic_image, panoptic_annotation["segments_info"])
+            add_instances(*existing_instances[image_id])
+
+        # The colormaps are listed while the workers process the first ones, skipping the images
+        # generated by the other stages
+        manifest.process(
+            iter_label_files(input_dir, exclude_suffixes=GENERATED_FILES, exclude_dirs=GENERATED_DIRS),
+            process_colormap_image,
+            lambda filepath, image_id: (filepath, panoptic_dir, semantic_dir, image_id, is_rugd, rugd_to_rellis,
+                                        instance_ids_store if save_instance_ids else None, png_level, rle),
+            add_result,
+            add_unchanged,
+            existing_panoptic.keys() & existing_instances.keys(),
+            n_proc,
+            initializer=get_label_registry, initargs=(is_rugd,), desc="Processing Colormaps",
+        )
+
+    print("Saving the class statistics {}".format(stats_file))
+    label_stats.save(stats_file, data_path.name, categories)
+
+    print_unmatched_report(merge_unmatched_reports(unmatched_reports), len(unmatched_reports))
+
+
+def main(args):
+    args, options = split_args(args)
+    save_instance_ids = "--save-instance-ids" in options
+    compact = "--compact" in options
+    rle = "--rle" in options
+    precision = None
+    instance_ids_store = get_label_store()
+    png_level = PNG_ARTIFACT_LEVEL
+    for arg in options:
+        if arg.startswith("--precision="):
+            precision = int(arg.split("=")[1])
+        elif arg.startswith("--label-format="):
+            instance_ids_store = get_label_store(arg.split("=")[1])
+        elif arg.startswith("--png-level="):
+            png_level = int(arg.split("=")[1])
+
+    if len(args) < 1:
+        print("Please pass directory path")
+        exit()
+
+    input_dir = args[0]
+
+    # "rugd_to_rellis" converts RUGD label colors to RELLIS-3D colors in memory while decoding
+    is_rugd = True
+    rugd_to_rellis = False
+    if len(args) > 1:
+        if args[1] in ("rellis", "rugd_to_rellis"):
+            is_rugd = False
+        rugd_to_rellis = args[1] == "rugd_to_rellis"
+
+    n_proc = 1
+    if len(args) > 2:
+        try:
+            n_proc = int(args[2])
+        except:
+            pass
+
+    start = time.time()
+
+    generate_panoptic_dataset(input_dir, is_rugd, n_proc, save_instance_ids, compact, precision, rugd_to_rellis, rle, instance_ids_store, png_level)
+
+    end = time.time()
+    print(f"TOOK {end-start} SECONDS!")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
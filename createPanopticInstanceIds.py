@@ -4,65 +4,54 @@ This script is used to generate instanceIds.png files for each colormap image ac
 The instanceIds.png images are stored using 16bit percision (each pixel can have 16bit values)
 
 This script will save the created instance id image in the same location as the input image.
+Processed images are recorded in manifest_instanceIds.json, so a rerun only processes new or changed images.
+A split manifest (labels/train.json, see splits.py) can be passed instead of a directory to only
+process the labels of that split; its manifest is then labels/manifest_train_instanceIds.json.
 
 Use this file in conjuction with labels.py to create instance id from image labels.
 Usage Example
     python createInstanceImgs.py /content/RUGD-annotations
 
+Pass "rellis" as the second argument for RELLIS-3D labels, or "rugd_to_rellis" to convert RUGD
+label colors to RELLIS-3D colors in memory instead of running convertRugdToRellisFormat first.
+
+Pass --label-format=npy (or npz, png:N) to store the instance ids in another format than png
+(see labelstore.py). npy files are much faster to write than png, and the scripts reading the
+instance ids accept any format.
+
 """
 
 import pathlib
 import sys
 import time
-from collections import Counter
-from multiprocessing import Pool
 
-import cv2
 import numpy as np
-import parallelbar
-from PIL import Image
-from scipy.spatial.distance import cdist
-from skimage.segmentation import flood_fill
-
-from labels import get_color2labels, get_id2labels
-
-
-def generateInstanceIds(image_array: np.ndarray, colors: np.ndarray, color_ids: np.ndarray, ids_to_labels) -> np.ndarray:
-    # Initialize output array
-    instance_ids = np.zeros((image_array.shape[0], image_array.shape[1]), dtype=np.int32)
-
-    # Match colors to label ids
-    R, C = np.where(cdist(image_array.reshape(-1, 3), colors) == 0)
-    instance_ids.ravel()[R] = color_ids[C]
-
-    # Make them negative (to determine which pixels have been visited)
-    instance_ids = -instance_ids
-
-    # Do flood fill to find instances
-    segment_count = Counter()
-    y_dim, x_dim = instance_ids.shape
-    for x in range(x_dim):
-        for y in range(y_dim):
-            if instance_ids[y][x] < 0:
-                label = ids_to_labels[-instance_ids[y][x]]
-                if label.hasInstances:
-                    # Keep track of unique instances
-                    new_val = label.id * 1000 + segment_count[label.id]
-                    segment_count[label.id] += 1
-                else:
-                    new_val = label.id
-                flood_fill(instance_ids, (y, x), new_val, connectivity=1, in_place=True)
-    
-    return instance_ids.astype(np.uint16)
 
+from colormap import colors_to_label_ids, load_colormap, merge_unmatched_reports, print_unmatched_report
+from components import label_instances
+from labels import LabelRegistry, get_label_registry, get_labels_version
+from labelstore import GENERATED_DIRS, GENERATED_FILES, INSTANCE_IDS_SUFFIX, get_label_store
+from manifest import StageManifest
+from scriptargs import split_args
+from splits import get_data_path, is_split_manifest, iter_label_files
+
+
+def generateInstanceIds(image_array: np.ndarray, registry: LabelRegistry) -> tuple:
+    # Match colors to label ids (unmatched colors are reported and set to void)
+    label_ids, unmatched = colors_to_label_ids(image_array, registry.color_lut)
 
-def target_process(args: tuple) -> str:
-    image_path, colors, color_ids, ids_to_labels = args
-    save_path = str(image_path).replace(".png", "") + "_instanceIds.png"
-    image = np.array(Image.open(image_path))
-    instance_image = generateInstanceIds(image, colors, color_ids, ids_to_labels)
-    cv2.imwrite(save_path, instance_image)
-    return save_path
+    # Label connected regions to find instances
+    instance_ids = label_instances(label_ids, registry.isthing)
+
+    return instance_ids, unmatched
+
+
+def target_process(args: tuple) -> tuple:
+    image_path, is_rugd, rugd_to_rellis, store = args
+    image = load_colormap(image_path, rugd_to_rellis)
+    instance_image, unmatched = generateInstanceIds(image, get_label_registry(is_rugd))
+    save_path = store.save(str(image_path).replace(".png", "") + INSTANCE_IDS_SUFFIX, instance_image)
+    return save_path, unmatched
 
 
 def main(args):
@@ -72,16 +61,26 @@ def main(args):
     Each process will be responsible for 5 separate images.
     """
 
+    args, options = split_args(args)
+
+    store = get_label_store()
+    for arg in options:
+        if arg.startswith("--label-format="):
+            store = get_label_store(arg.split("=")[1])
+
     if len(args) < 1:
         print("Please pass directory path")
         exit()
 
     input_dir = args[0]
 
+    # "rugd_to_rellis" converts RUGD label colors to RELLIS-3D colors in memory while decoding
     is_rugd = True
+    rugd_to_rellis = False
     if len(args) > 1:
-        if args[1] == "rellis":
+        if args[1] in ("rellis", "rugd_to_rellis"):
             is_rugd = False
+        rugd_to_rellis = args[1] == "rugd_to_rellis"
 
     n_proc = 2
     if len(args) > 2:
@@ -92,33 +91,38 @@ def main(args):
 
     start = time.time()
 
-    colormap_imgs = list(pathlib.Path(input_dir).glob("**/*.png"))
-    label_imgs = []
-
-    for file in colormap_imgs:
-        if '_panoptic.png' in file.name:
-            continue
-
-        if '_instanceIds.png' in file.name:
-            continue
-
-        instance_path = pathlib.Path(str(file).replace('.png', '') + '_instanceIds.png')
-        if not pathlib.Path.exists(instance_path):
-            label_imgs.append(file)
-
-    color2labels = get_color2labels(is_rugd)
-    colors = np.array([k for k in color2labels.keys()])
-    color_ids = np.array([v.id for v in color2labels.values()])
-    ids_to_labels = get_id2labels(is_rugd)
-
-    with Pool():
-        results = parallelbar.progress_imap(
-            func=target_process,
-            tasks=[(label_image, colors, color_ids, ids_to_labels) for label_image in label_imgs],
-            n_cpu=n_proc,
-            chunk_size=10,
-        )
-        print(f"{len(results)} files generated")
+    if is_split_manifest(input_dir):
+        data_path = get_data_path(input_dir)
+        manifest_path = data_path.parent.joinpath(f"manifest_{data_path.name}_instanceIds.json")
+    else:
+        manifest_path = pathlib.Path(input_dir).joinpath("manifest_instanceIds.json")
+
+    # Only process images that are new, changed or were processed with different labels
+    # Switching the storage format reprocesses every image
+    labels_version = get_labels_version(is_rugd) + ("" if str(store) == "png" else f":{store}")
+    manifest = StageManifest(manifest_path, labels_version)
+
+    def add_result(result):
+        save_path, unmatched = result
+        if unmatched:
+            unmatched_reports.append(unmatched)
+        return [save_path]
+
+    # The colormaps are listed while the workers process the first ones, skipping the images
+    # generated by the other stages. Each worker loads the label tables once.
+    unmatched_reports = []
+    manifest.process(
+        iter_label_files(input_dir, exclude_suffixes=GENERATED_FILES, exclude_dirs=GENERATED_DIRS),
+        target_process,
+        lambda filepath, image_id: (filepath, is_rugd, rugd_to_rellis, store),
+        add_result,
+        n_proc=n_proc,
+        initializer=get_label_registry,
+        initargs=(is_rugd,),
+        desc="Generating Instance Ids",
+    )
+
+    print_unmatched_report(merge_unmatched_reports(unmatched_reports), len(unmatched_reports))
 
     end = time.time()
     print(f"TOOK {end-start} SECONDS!")
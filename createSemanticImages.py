@@ -0,0 +1,95 @@
+"""
+Native replacement for panopticapi's panoptic2semantic_segmentation.py converter.
+
+Usage Example:
+    python createSemanticImages.py /path/to/labels/train rellis 8 [--keep-things] [--png-level=N]
+
+This script reads the annotations_<name>_panoptic.json file and the panoptic png images in
+<name>_panoptic/ created by createPanopticAnnotationsParallel.py, and saves the semantic
+segmentation png images in <name>_semantic/. The categories come from labels.py.
+By default thing pixels are set to 183, like panopticapi's --things_other option.
+Pass --keep-things to keep the thing category ids instead, and --png-level=N to set the zlib
+compression level (0-9) of the semantic images.
+
+createPanopticAnnotationsParallel.py --semantic and createPanopticDataset.py write the semantic
+images while creating the panoptic images, so this script is only needed for existing datasets.
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from executor import parallel_imap
+from labelstore import PNG_ARTIFACT_LEVEL, PngStore
+from scriptargs import split_args
+from segments import get_label_category_to_semantic, panoptic_to_semantic
+from splits import get_data_path
+
+
+def generate_semantic_image(args) -> str:
+    annotation, panoptic_dir, semantic_dir, is_rugd, things_other, png_level = args
+    pan_format = np.array(Image.open(panoptic_dir.joinpath(annotation["file_name"])).convert("RGB"))
+    semantic = panoptic_to_semantic(pan_format, annotation["segments_info"], get_label_category_to_semantic(is_rugd, things_other))
+
+    return PngStore(png_level).save(semantic_dir.joinpath(Path(annotation["file_name"]).stem), semantic)
+
+
+def generate_semantic_images(input_dir: str, is_rugd: bool = True, n_proc: int = 1, things_other: bool = True, png_level: int = PNG_ARTIFACT_LEVEL):
+    data_path = get_data_path(input_dir)
+    annotations_file = data_path.parent.joinpath(f"annotations_{data_path.name}_panoptic.json")
+    panoptic_dir = data_path.parent.joinpath(f"{data_path.name}_panoptic")
+    semantic_dir = data_path.parent.joinpath(f"{data_path.name}_semantic")
+    if not os.path.exists(semantic_dir):
+        os.mkdir(semantic_dir)
+
+    with open(annotations_file) as f:
+        annotations = json.load(f)["annotations"]
+
+    tasks = [(annotation, panoptic_dir, semantic_dir, is_rugd, things_other, png_level) for annotation in annotations]
+    results = list(parallel_imap(generate_semantic_image, tasks, n_proc, initializer=get_label_category_to_semantic,
+                                 initargs=(is_rugd, things_other), desc="Generating Semantic Images"))
+
+    print(f"{len(results)} files generated in {semantic_dir}")
+
+
+def main(args):
+    args, options = split_args(args)
+    things_other = "--keep-things" not in options
+    png_level = PNG_ARTIFACT_LEVEL
+    for arg in options:
+        if arg.startswith("--png-level="):
+            png_level = int(arg.split("=")[1])
+
+    if len(args) < 1:
+        print("Please pass directory path")
+        exit()
+
+    input_dir = args[0]
+
+    is_rugd = True
+    if len(args) > 1:
+        if args[1] == "rellis":
+            is_rugd = False
+
+    n_proc = 1
+    if len(args) > 2:
+        try:
+            n_proc = int(args[2])
+        except:
+            pass
+
+    start = time.time()
+
+    generate_semantic_images(input_dir, is_rugd, n_proc, things_other, png_level)
+
+    end = time.time()
+    print(f"TOOK {end-start} SECONDS!")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,40 @@
+"""
+Streaming file discovery.
+
+scan_files walks a directory tree with os.scandir and yields every matching file as soon as its
+directory entry is read, so the workers can start on the first files while the rest of the tree,
+or of a large flat directory, is still being listed, which can take minutes on network storage.
+Files are filtered on their directory entry names, without any stat or Path.exists call, and
+excluded directories aren't entered at all.
+
+Files are yielded in the file system's listing order, not sorted. The stages keep the image id of
+every file in their manifest, so the ids stay the same across reruns.
+"""
+
+import os
+from pathlib import Path
+
+
+def _as_tuple(suffixes) -> tuple:
+    return (suffixes,) if isinstance(suffixes, str) else tuple(suffixes)
+
+
+def _scan(root: str, relative: str, suffixes: tuple, exclude_suffixes: tuple, exclude_dirs: tuple):
+    with os.scandir(os.path.join(root, relative)) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.name.endswith(exclude_dirs):
+                    yield from _scan(root, relative + entry.name + "/", suffixes, exclude_suffixes, exclude_dirs)
+            elif entry.name.endswith(suffixes) and not entry.name.endswith(exclude_suffixes):
+                yield relative + entry.name, Path(entry.path)
+
+
+def scan_files(root, suffixes, exclude_suffixes=(), exclude_dirs=()):
+    """
+    Yield the (relative posix path, path) of every file under root whose name ends with one of
+    suffixes and none of exclude_suffixes. Directories whose name ends with one of exclude_dirs
+    are skipped.
+    """
+    if not os.path.isdir(root):
+        return
+    yield from _scan(str(root), "", _as_tuple(suffixes), _as_tuple(exclude_suffixes), _as_tuple(exclude_dirs))
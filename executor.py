@@ -0,0 +1,120 @@
+"""
+Shared worker pool for the parallel preprocessing stages.
+
+parallel_imap creates exactly n_proc worker processes (or none with n_proc=1), runs an optional
+initializer once in every worker to load per-process state such as the label tables, picks a chunk
+size from the number of tasks, shows a progress bar and yields the results in task order as they
+are ready. When it's done it reports how many tasks each worker ran and its throughput.
+With threads=True the workers are threads instead, for tasks that mostly wait on I/O or on codecs
+that release the GIL.
+"""
+
+import math
+import os
+import threading
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from tqdm.auto import tqdm
+
+# Function run by the tasks of the current worker process, set by _init_worker
+_worker_func = None
+
+
+def auto_chunksize(n_tasks: int, n_proc: int) -> int:
+    """
+    About 4 chunks per worker like multiprocessing's Pool.map, so the workers stay balanced, and at
+    most 32 tasks per chunk, so the results keep streaming in on large datasets.
+    """
+    if not n_tasks:
+        return 1
+    return max(1, min(32, math.ceil(n_tasks / (n_proc * 4))))
+
+
+def _adaptive_chunks(tasks, n_proc: int):
+    """
+    Group tasks of unknown count into chunks sized by auto_chunksize for the number of tasks seen so
+    far: single tasks first, so small inputs are spread over every worker, growing to 32 tasks.
+    """
+    chunk, n_seen, size = [], 0, 1
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) >= size:
+            yield chunk
+            n_seen += len(chunk)
+            chunk, size = [], auto_chunksize(n_seen, n_proc)
+    if chunk:
+        yield chunk
+
+
+def _init_worker(func, initializer, initargs):
+    global _worker_func
+    _worker_func = func
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_task(task) -> tuple:
+    start = time.perf_counter()
+    result = _worker_func(task)
+    return (os.getpid(), threading.get_ident()), time.perf_counter() - start, result
+
+
+def _run_chunk(chunk: list) -> list:
+    return [_run_task(task) for task in chunk]
+
+
+def print_worker_report(worker_stats: dict, elapsed: float):
+    """worker_stats maps a worker's (pid, thread id) to [number of tasks, busy seconds]."""
+    if not worker_stats:
+        return
+
+    n_tasks = sum(n for n, _ in worker_stats.values())
+    print(f"{n_tasks} tasks in {elapsed:.2f} seconds ({n_tasks / max(elapsed, 1e-9):.2f} tasks/s) on {len(worker_stats)} workers")
+    for index, (n, busy) in enumerate(worker_stats.values()):
+        print(f"    worker {index}: {n} tasks, {n / max(busy, 1e-9):.2f} tasks/s while busy, busy {100 * busy / max(elapsed, 1e-9):.0f}% of the time")
+
+
+def parallel_imap(func, tasks, n_proc: int = 1, initializer=None, initargs: tuple = (), chunksize: int = None,
+                  total: int = None, desc: str = None, report: bool = True, threads: bool = False):
+    """
+    Yield func(task) for every task, in task order. func, the initializer and the tasks must be picklable.
+    tasks can be any iterable; pass total when it has no len() to size the chunks and the progress bar.
+    Without a total, the tasks are sent to the workers in chunks that grow as more tasks are read
+    (see _adaptive_chunks), unless chunksize is given.
+    """
+    if total is None and hasattr(tasks, "__len__"):
+        total = len(tasks)
+    adaptive = chunksize is None and total is None
+    if chunksize is None and total is not None:
+        chunksize = auto_chunksize(total, n_proc)
+
+    worker_stats = {}
+    start = time.perf_counter()
+    if n_proc <= 1:
+        # Run in this process instead of starting a single worker
+        _init_worker(func, initializer, initargs)
+        results = map(_run_task, tasks)
+        pool = None
+    else:
+        pool_type = ThreadPool if threads else Pool
+        pool = pool_type(n_proc, initializer=_init_worker, initargs=(func, initializer, initargs))
+        if adaptive:
+            results = (result for chunk in pool.imap(_run_chunk, _adaptive_chunks(tasks, n_proc)) for result in chunk)
+        else:
+            results = pool.imap(_run_task, tasks, chunksize=chunksize)
+
+    try:
+        for worker, seconds, result in tqdm(results, total=total, desc=desc):
+            stats = worker_stats.setdefault(worker, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if report:
+        print_worker_report(worker_stats, time.perf_counter() - start)
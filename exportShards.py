@@ -0,0 +1,126 @@
+"""
+Packs a dataset split into a few large memory-mappable shards for training.
+
+Usage Example:
+    python exportShards.py /path/to/images/train /path/to/labels/train 8 [--shard-size=1024] [--skip-panoptic] [--output=/path/to/shards]
+
+This script reads the annotations_<name>_panoptic.json file, the panoptic png images in
+<name>_panoptic/ and the semantic png images in <name>_semantic/ (see createPanopticDataset.py),
+along with the matching jpg images of the images directory, and packs them into
+<name>_shards/ next to the labels directory (see shards.py for the format).
+
+The images are copied as-is, while the labels are decoded once here and stored as raw arrays,
+so the training data loader doesn't need to decode any png. --shard-size is the size of a shard
+in MB (1024 by default). The panoptic segment ids aren't needed to train PanopticFPN from the
+semantic images and instance annotations; pass --skip-panoptic to leave them out.
+
+A split manifest (see splits.py) can be passed instead of the two directories, in which case the
+images are read from the paths it lists:
+    python exportShards.py /path/to/labels/train.json 8
+
+Register the shards for training with register_sharded_panoptic_separated from registerShards.py.
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from executor import parallel_imap
+from scriptargs import split_args
+from segments import rgb2id
+from shards import ShardWriter
+from splits import get_data_path, is_split_manifest, load_split
+
+
+def load_record(args) -> tuple:
+    name, image_path, panoptic_path, semantic_path = args
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+
+    semantic = np.array(Image.open(semantic_path))
+    panoptic_ids = None
+    if panoptic_path is not None:
+        panoptic_ids = rgb2id(np.array(Image.open(panoptic_path).convert("RGB")))
+
+    return name, image_bytes, semantic, panoptic_ids
+
+
+def export_shards(image_dir: str, input_dir: str, n_proc: int = 1, shard_size: int = 1024, skip_panoptic: bool = False, output_dir: str = None):
+    data_path = get_data_path(input_dir)
+    panoptic_file = data_path.parent.joinpath(f"annotations_{data_path.name}_panoptic.json")
+    panoptic_dir = data_path.parent.joinpath(f"{data_path.name}_panoptic")
+    semantic_dir = data_path.parent.joinpath(f"{data_path.name}_semantic")
+    shard_dir = Path(output_dir) if output_dir else data_path.parent.joinpath(f"{data_path.name}_shards")
+
+    with open(panoptic_file) as f:
+        annotations = json.load(f)["annotations"]
+
+    if is_split_manifest(input_dir):
+        images = {name: image for name, (image, _) in load_split(input_dir).items()}
+    else:
+        images = {Path(a["file_name"]).stem: Path(image_dir).joinpath(Path(a["file_name"]).with_suffix(".jpg")) for a in annotations}
+
+    tasks = []
+    for annotation in annotations:
+        file_name = annotation["file_name"]
+        stem = Path(file_name).stem
+        tasks.append((
+            stem,
+            images[stem],
+            None if skip_panoptic else panoptic_dir.joinpath(file_name),
+            semantic_dir.joinpath(file_name),
+        ))
+
+    # Workers decode the labels while this process appends the records to the shards in order
+    with ShardWriter(shard_dir, shard_size << 20) as writer:
+        for name, image_bytes, semantic, panoptic_ids in parallel_imap(load_record, tasks, n_proc, desc="Exporting Shards"):
+            writer.add(name, image_bytes, semantic, panoptic_ids)
+
+    n_shards = len(list(shard_dir.glob("shard-*.bin")))
+    size = sum(f.stat().st_size for f in shard_dir.glob("shard-*.bin"))
+    print(f"{len(tasks)} images packed into {n_shards} shards ({size / (1 << 20):.1f} MB) in {shard_dir}")
+
+
+def main(args):
+    args, options = split_args(args)
+    skip_panoptic = "--skip-panoptic" in options
+    shard_size = 1024
+    output_dir = None
+    for arg in options:
+        if arg.startswith("--shard-size="):
+            shard_size = int(arg.split("=")[1])
+        elif arg.startswith("--output="):
+            output_dir = arg.split("=", 1)[1]
+
+    # A split manifest replaces both directories
+    if len(args) > 0 and is_split_manifest(args[0]):
+        args = [None] + args
+
+    if len(args) < 2:
+        print("Please pass the images and labels directory paths")
+        exit()
+
+    image_dir = args[0]
+    input_dir = args[1]
+
+    n_proc = 1
+    if len(args) > 2:
+        try:
+            n_proc = int(args[2])
+        except:
+            pass
+
+    start = time.time()
+
+    export_shards(image_dir, input_dir, n_proc, shard_size, skip_panoptic, output_dir)
+
+    end = time.time()
+    print(f"TOOK {end-start} SECONDS!")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,14 +1,23 @@
+import math
 import os
 import re
 import shutil
-from multiprocessing import Pool
+import time
+from collections import Counter
 from pathlib import Path
 
-import parallelbar
+import numpy as np
 from PIL import Image
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
+from colormap import colors_to_label_ids, load_colormap
+from discovery import scan_files
+from executor import parallel_imap
+from labels import get_label_registry
+from labelstore import GENERATED_FILES
+from splits import save_split
+
 
 def _split_name(filename):
     parts = re.split(r"\.|/|\\", str(filename))
@@ -99,21 +108,161 @@ def generate_split_datasets(dataset_path, images_extract_path, labels_extract_pa
     return processed_images_path, processed_labels_path
 
 
-def _change_image_ext(args):
-    filename, from_ext, to_ext = args
-    image = Image.open(filename)
-    image.save(str(filename).replace(from_ext, to_ext))
+def _find_files(extract_path, file_ext) -> dict:
+    files = {}
+    # Skip the files generated by the preprocessing scripts next to the labels
+    for _, f in scan_files(extract_path, f".{file_ext}", exclude_suffixes=GENERATED_FILES):
+        files[_split_name(f)[0]] = f
+    return files
+
+
+def _get_class_presence(args) -> np.ndarray:
+    label_path, is_rugd = args
+    registry = get_label_registry(is_rugd)
+    label_ids, _ = colors_to_label_ids(load_colormap(label_path), registry.color_lut)
+    return np.bincount(label_ids.ravel(), minlength=256)[:len(registry.labels)] > 0
+
+
+def _get_stratify_keys(presence: np.ndarray, max_keys: int) -> list:
+    """
+    Stratify multi-label samples by the rarest class present in each of them. Only the max_keys - 1
+    most common of these classes are kept as keys (with at least 2 samples each), the other
+    samples share one key.
+    """
+    class_counts = presence.sum(axis=0)
+    # Absent classes can't be the rarest present class
+    rarity = np.where(presence, class_counts, np.iinfo(np.int64).max)
+    keys = rarity.argmin(axis=1)
+    keys[~presence.any(axis=1)] = -1
+
+    common = {key for key, count in Counter(keys.tolist()).most_common(max(max_keys - 1, 0)) if count >= 2}
+    keys = [key if key in common else -2 for key in keys.tolist()]
+    if Counter(keys)[-2] == 1:
+        # A single rare sample can't be stratified alone, so it joins the most common key
+        most_common = Counter(keys).most_common(1)[0][0]
+        keys = [most_common if key == -2 else key for key in keys]
+    return keys
+
+
+def _split(indices: np.ndarray, presence: np.ndarray, size: float, random_state: int) -> tuple:
+    if presence is None:
+        return train_test_split(indices, test_size=size, random_state=random_state)
+
+    # Every key needs a sample in both splits
+    n_test = math.ceil(size * len(indices))
+    keys = _get_stratify_keys(presence[indices], min(n_test, len(indices) - n_test))
+    return train_test_split(indices, test_size=size, random_state=random_state, stratify=keys)
+
+
+def generate_split_manifests(
+    dataset_path,
+    images_extract_path,
+    labels_extract_path,
+    test_size=0.2,
+    val_size=0.0,
+    random_state=123,
+    stratify=False,
+    is_rugd=True,
+    n_proc=1,
+):
+    """
+    Split the extracted dataset without moving any file. The train/test(/val) split manifests are
+    written to <dataset_path>/labels/<split>.json, and can be passed to the preprocessing scripts
+    instead of a labels directory (see splits.py). Rerun with another test_size or random_state to
+    re-split instantly. With stratify=True the splits are stratified by the classes present in
+    each label image (the colormaps are decoded once, in parallel with n_proc processes).
+    """
+    labels_path = Path(dataset_path).joinpath("labels")
+    labels_path.mkdir(parents=True, exist_ok=True)
+
+    images = _find_files(images_extract_path, "jpg")
+    labels = _find_files(labels_extract_path, "png")
+    names = sorted(images.keys() & labels.keys())
+    print(f"{len(names)} paired images, {len(images.keys() ^ labels.keys())} unpaired images or labels skipped")
 
+    presence = None
+    if stratify:
+        tasks = [(labels[name], is_rugd) for name in names]
+        presence = np.array(list(parallel_imap(
+            _get_class_presence, tasks, n_proc,
+            initializer=get_label_registry, initargs=(is_rugd,), desc="Reading Class Presence",
+        )))
 
-def change_file_extensions(images_dir, from_ext, to_ext, n_proc=1):
-    image_files = list(Path(images_dir).glob(f"**/*{from_ext}"))
+    train, test = _split(np.arange(len(names)), presence, test_size, random_state)
+    splits = [("train", train), ("test", test)]
+    if val_size:
+        # val_size is a fraction of the whole dataset, like test_size
+        train, val = _split(train, presence, val_size / (1 - test_size), random_state)
+        splits = [("train", train), ("test", test), ("val", val)]
+    elif labels_path.joinpath("val.json").exists():
+        # Don't leave the val split of a previous run behind
+        os.remove(labels_path.joinpath("val.json"))
 
-    with Pool():
-        parallelbar.progress_imap(
-            func=_change_image_ext,
-            tasks=[(image_filename, from_ext, to_ext) for image_filename in image_files],
-            n_cpu=n_proc,
-            chunk_size=10,
-        )
+    info = {"test_size": test_size, "val_size": val_size, "random_state": random_state, "stratify": stratify}
+    manifest_paths = []
+    for split_name, split in splits:
+        manifest_path = labels_path.joinpath(f"{split_name}.json")
+        save_split(manifest_path, {names[i]: (images[names[i]], labels[names[i]]) for i in split}, info)
+        manifest_paths.append(manifest_path)
+        print(f"{len(split)} {split_name} samples saved to {manifest_path}")
 
+    return manifest_paths
+
+
+# PIL's JPEG subsampling values
+CHROMA_SUBSAMPLING = {"4:4:4": 0, "4:2:2": 1, "4:2:0": 2}
+
+
+def _transcode_image(args) -> tuple:
+    """Returns (status, source bytes, target bytes), status being "converted" or "skipped"."""
+    filename, target, save_options, remove_source = args
+    source_size = os.path.getsize(filename)
+
+    # Skip the images converted by a previous run (targets are only created once complete)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(filename):
+        status = "skipped"
+    else:
+        with Image.open(filename) as image:
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            tmp_target = f"{target}.tmp"
+            image.save(tmp_target, format=Image.registered_extensions()[Path(target).suffix.lower()], **save_options)
+        os.replace(tmp_target, target)
+        status = "converted"
+
+    target_size = os.path.getsize(target)
+    if remove_source:
+        os.remove(filename)
+    return status, source_size, target_size
+
+
+def change_file_extensions(images_dir, from_ext, to_ext, n_proc=1, quality=75, subsampling="4:2:0", remove_source=False):
+    """
+    Transcode every image ending with from_ext to to_ext in n_proc threads (the image codecs release
+    the GIL). quality and subsampling ("4:4:4", "4:2:2" or "4:2:0") are used for JPEG targets, and
+    the defaults match PIL's. Images whose target is already newer than the source are skipped,
+    so an interrupted run can be resumed (delete the targets to re-encode them with other settings). remove_source=True deletes every source once its target exists.
+    """
+    start = time.time()
+    # The images are listed while the threads transcode the first ones. The new targets don't end
+    # with from_ext, so they aren't picked up.
+    image_files = scan_files(images_dir, from_ext)
+
+    save_options = {}
+    if to_ext.lower() in (".jpg", ".jpeg"):
+        save_options = {"quality": quality, "subsampling": CHROMA_SUBSAMPLING[subsampling]}
+
+    tasks = (
+        (image_filename, image_filename.with_name(image_filename.name[:-len(from_ext)] + to_ext), save_options, remove_source)
+        for _, image_filename in image_files
+    )
+    results = list(parallel_imap(_transcode_image, tasks, n_proc, desc="Changing File Extensions", threads=True))
 
+    elapsed = time.time() - start
+    converted = [(source_size, target_size) for status, source_size, target_size in results if status == "converted"]
+    source_mb = sum(source_size for source_size, _ in converted) / (1 << 20)
+    target_mb = sum(target_size for _, target_size in converted) / (1 << 20)
+    print(f"{len(converted)} images converted, {len(results) - len(converted)} already up to date")
+    print(f"{source_mb:.1f} MB -> {target_mb:.1f} MB, {len(converted) / max(elapsed, 1e-9):.1f} images/s, {source_mb / max(elapsed, 1e-9):.1f} MB/s read")
+    if remove_source:
+        print(f"{len(results)} source images removed")
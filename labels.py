@@ -1,9 +1,13 @@
 # Inspired by https://github.com/mcordts/cityscapesScripts/helpers/labels.py
 
 
+import hashlib
 from collections import namedtuple
+from functools import lru_cache
 from typing import List, Dict
 
+import numpy as np
+
 Label = namedtuple( 'Label' , [
     'name'        ,
     'id'          , 
@@ -55,18 +59,91 @@ def get_labels(is_rugd: bool = True) -> List[Label]:
     return labels
 
 
+# Dense lookup tables of the labels of a dataset, so class decisions can be made with array indexing
+LabelRegistry = namedtuple( 'LabelRegistry' , [
+    'labels'           , # tuple of Label
+    'color_lut'        , # (2^24,) uint8: color key (R << 16 | G << 8 | B) -> label id, UNMATCHED_ID for other colors
+    'isthing'          , # (n,) bool: label id -> hasInstances
+    'category_ids'     , # (n,) uint8: label id -> categoryId
+    'colors'           , # (n, 3) uint8: label id -> color
+    'instance_to_label', # (2^16,) uint8: instance id -> label id (thing instance ids are label id * 1000 + n), 0 for unknown ids
+    'version'          , # see get_labels_version
+    ] )
+
+# Value stored in the color lookup table for colors that don't belong to any label
+UNMATCHED_ID = 255
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+@lru_cache(maxsize=None)
+def get_label_registry(is_rugd: bool = True) -> LabelRegistry:
+    """Cached, read-only label tables of a dataset. Each process builds them once per dataset."""
+    labels = tuple(get_labels(is_rugd))
+    n_labels = max(label.id for label in labels) + 1
+
+    color_lut = np.full(1 << 24, UNMATCHED_ID, dtype=np.uint8)
+    isthing = np.zeros(n_labels, dtype=bool)
+    category_ids = np.zeros(n_labels, dtype=np.uint8)
+    colors = np.zeros((n_labels, 3), dtype=np.uint8)
+    for label in labels:
+        r, g, b = label.color
+        color_lut[(r << 16) | (g << 8) | b] = label.id
+        isthing[label.id] = label.hasInstances
+        category_ids[label.id] = label.categoryId
+        colors[label.id] = label.color
+
+    instance_ids = np.arange(1 << 16)
+    instance_to_label = np.where(instance_ids >= 1000, instance_ids // 1000, instance_ids)
+    # Ids that don't belong to any label are void
+    instance_to_label[instance_to_label >= n_labels] = 0
+    instance_to_label = instance_to_label.astype(np.uint8)
+
+    return LabelRegistry(
+        labels=labels,
+        color_lut=_read_only(color_lut),
+        isthing=_read_only(isthing),
+        category_ids=_read_only(category_ids),
+        colors=_read_only(colors),
+        instance_to_label=_read_only(instance_to_label),
+        version=hashlib.sha1(repr(list(labels)).encode()).hexdigest()[:12],
+    )
+
+
 def get_color2labels(is_rugd: bool = True) -> Dict[tuple, Label]:
-    return { label.color: label for label in get_labels(is_rugd) }
+    return { label.color: label for label in get_label_registry(is_rugd).labels }
 
 
 def get_id2labels(is_rugd: bool = True) -> Dict[int, Label]:
-    return { label.id: label for label in get_labels(is_rugd) }
+    return { label.id: label for label in get_label_registry(is_rugd).labels }
 
 
 def get_conflict_colormap() -> Dict[tuple, tuple]:
     conflict_colormap = {}
-    for rugd_label, rellis_label in zip(get_labels(is_rugd=True), get_labels(is_rugd=False)):
+    for rugd_label, rellis_label in zip(get_label_registry(is_rugd=True).labels, get_label_registry(is_rugd=False).labels):
         if rugd_label.color != rellis_label.color:
             conflict_colormap[rugd_label.color] = rellis_label.color
 
     return conflict_colormap
+
+
+def get_categories(is_rugd: bool = True) -> List[Dict]:
+    """COCO category entries for every label (including void)."""
+    return [
+        {
+            "id": int(label.id),
+            "name": label.name,
+            "color": label.color,
+            "supercategory": label.category,
+            "isthing": 1 if label.hasInstances else 0
+        }
+        for label in get_label_registry(is_rugd).labels
+    ]
+
+
+def get_labels_version(is_rugd: bool = True) -> str:
+    """Short hash of the label definitions, used to invalidate preprocessed outputs when they change."""
+    return get_label_registry(is_rugd).version
@@ -0,0 +1,131 @@
+"""
+Per-category statistics of a dataset split, to balance the semantic and ROI heads.
+
+The workers compute the statistics of every image from the segment areas they already have
+(see segments.get_segment_stats) with a few bincounts, and the main process sums them into a
+LabelStats. Images that a rerun doesn't process again are added back from the segments_info of
+their existing panoptic annotations, which hold the same areas.
+
+stats.json, next to categories.json, holds one entry per split with, for every category:
+    - pixel_count, image_count: pixels of the category and number of images it appears in
+    - instance_count, instance_sizes: thing instances and their area histogram, where bin k counts
+      the instances of 2^k to 2^(k+1) - 1 pixels (the last bin also counts the larger ones)
+    - pixel_weight: median frequency balancing weight, median(freq) / freq(c) with
+      freq(c) = pixels of c / pixels of the images c appears in (Eigen and Fergus, 2015)
+    - instance_weight: median(instance counts) / instance count of c, for thing categories
+Weights are 0 for categories that don't appear in the split. semantic_head_weights lists the
+pixel weights of the stuff categories (including void) and roi_head_weights the instance weights
+of the thing categories, both in category id order like the heads' outputs (see README.md).
+"""
+
+import json
+import os
+
+import numpy as np
+
+# Number of instance size histogram bins, the last one starts at 2^23 pixels
+SIZE_BINS = 24
+
+
+def get_image_stats(category_ids: np.ndarray, areas: np.ndarray, n_pixels: int, isthing: np.ndarray) -> tuple:
+    """
+    (pixel_counts, instance_counts, instance_sizes) of an image from the category ids and areas of
+    its non-void segments. isthing is a boolean array indexed by label id.
+    """
+    n_labels = len(isthing)
+    category_ids = np.asarray(category_ids, dtype=np.int64)
+    areas = np.asarray(areas, dtype=np.int64)
+
+    pixel_counts = np.bincount(category_ids, weights=areas, minlength=n_labels).astype(np.int64)
+    # Void pixels aren't part of any segment
+    pixel_counts[0] += n_pixels - areas.sum()
+
+    things = isthing[category_ids]
+    thing_ids = category_ids[things]
+    instance_counts = np.bincount(thing_ids, minlength=n_labels)
+
+    # frexp gives area = m * 2^e with 0.5 <= m < 1, so bin e - 1 holds 2^(e-1) <= area < 2^e
+    _, exponents = np.frexp(areas[things])
+    size_bins = np.minimum(exponents - 1, SIZE_BINS - 1)
+    instance_sizes = np.bincount(thing_ids * SIZE_BINS + size_bins, minlength=n_labels * SIZE_BINS)
+
+    return pixel_counts, instance_counts, instance_sizes.reshape(n_labels, SIZE_BINS)
+
+
+def _median_balanced(frequencies: np.ndarray) -> np.ndarray:
+    present = frequencies > 0
+    weights = np.zeros(len(frequencies))
+    if present.any():
+        weights[present] = np.median(frequencies[present]) / frequencies[present]
+    return weights
+
+
+class LabelStats:
+    def __init__(self, isthing: np.ndarray):
+        n_labels = len(isthing)
+        self.isthing = isthing
+        self.n_images = 0
+        self.pixel_counts = np.zeros(n_labels, dtype=np.int64)
+        self.image_counts = np.zeros(n_labels, dtype=np.int64)
+        # Pixels of the images each category appears in, for the median frequency weights
+        self.image_pixels = np.zeros(n_labels, dtype=np.int64)
+        self.instance_counts = np.zeros(n_labels, dtype=np.int64)
+        self.instance_sizes = np.zeros((n_labels, SIZE_BINS), dtype=np.int64)
+
+    def add(self, image_stats: tuple):
+        """Add the get_image_stats of an image."""
+        pixel_counts, instance_counts, instance_sizes = image_stats
+        present = pixel_counts > 0
+        self.n_images += 1
+        self.pixel_counts += pixel_counts
+        self.image_counts += present
+        self.image_pixels[present] += pixel_counts.sum()
+        self.instance_counts += instance_counts
+        self.instance_sizes += instance_sizes
+
+    def add_segments_info(self, image_entry: dict, segments_info: list):
+        """Add an image from its COCO panoptic image entry and segments_info."""
+        self.add(get_image_stats(
+            [segment["category_id"] for segment in segments_info],
+            [segment["area"] for segment in segments_info],
+            image_entry["width"] * image_entry["height"],
+            self.isthing,
+        ))
+
+    def to_json(self, categories: list) -> dict:
+        """categories are the labels.get_categories entries."""
+        frequencies = self.pixel_counts / np.maximum(self.image_pixels, 1)
+        pixel_weights = _median_balanced(frequencies)
+        instance_weights = _median_balanced(np.where(self.isthing, self.instance_counts, 0).astype(np.float64))
+
+        return {
+            "images": self.n_images,
+            "pixels": int(self.pixel_counts.sum()),
+            "instances": int(self.instance_counts.sum()),
+            "categories": [
+                {
+                    "id": category["id"],
+                    "name": category["name"],
+                    "isthing": category["isthing"],
+                    "pixel_count": int(self.pixel_counts[category["id"]]),
+                    "image_count": int(self.image_counts[category["id"]]),
+                    "instance_count": int(self.instance_counts[category["id"]]),
+                    "instance_sizes": self.instance_sizes[category["id"]].tolist(),
+                    "pixel_weight": float(pixel_weights[category["id"]]),
+                    "instance_weight": float(instance_weights[category["id"]]),
+                }
+                for category in categories
+            ],
+            "semantic_head_weights": [float(pixel_weights[c["id"]]) for c in categories if not c["isthing"]],
+            "roi_head_weights": [float(instance_weights[c["id"]]) for c in categories if c["isthing"]],
+        }
+
+    def save(self, stats_file, split: str, categories: list):
+        """Write the statistics of split to stats_file, keeping the entries of the other splits."""
+        stats = {}
+        if os.path.exists(stats_file):
+            with open(stats_file) as f:
+                stats = json.load(f)
+        stats[split] = self.to_json(categories)
+        with open(stats_file, "w") as f:
+            json.dump(stats, f, indent=4)
@@ -0,0 +1,111 @@
+"""
+Storage backends for the label images written by the preprocessing scripts.
+
+The intermediate instance id images can be stored as
+    - "png" or "png:N": 16 bit png, with zlib compression level N (0-9, OpenCV's default 1 if not given)
+    - "npy": raw numpy array, the fastest to write and memory-mapped when read back
+    - "npz": zlib compressed numpy array
+so they're cheap to write, while the panoptic and semantic images read by detectron2 stay png
+files, compressed with PNG_ARTIFACT_LEVEL unless --png-level=N is passed.
+
+Arrays are in RGB order like PIL's; pass bgr=True for OpenCV's BGR order.
+"""
+
+import cv2
+import numpy as np
+
+# zlib level of the panoptic and semantic png images, PIL's default
+PNG_ARTIFACT_LEVEL = 6
+
+INSTANCE_IDS_SUFFIX = "_instanceIds"
+
+
+class PngStore:
+    ext = ".png"
+
+    def __init__(self, level: int = None):
+        self.level = level
+
+    def __repr__(self) -> str:
+        return "png" if self.level is None else f"png:{self.level}"
+
+    def save(self, path, array: np.ndarray, bgr: bool = False) -> str:
+        """Save array to path plus this store's extension and return the saved path."""
+        path = str(path) + self.ext
+        if array.ndim == 3 and not bgr:
+            array = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+        params = [] if self.level is None else [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+        if not cv2.imwrite(path, array, params):
+            raise IOError(f"Could not write {path}")
+        return path
+
+
+class NpyStore:
+    ext = ".npy"
+
+    def __repr__(self) -> str:
+        return "npy"
+
+    def save(self, path, array: np.ndarray, bgr: bool = False) -> str:
+        path = str(path) + self.ext
+        np.save(path, array[:, :, ::-1] if array.ndim == 3 and bgr else array)
+        return path
+
+
+class NpzStore:
+    ext = ".npz"
+
+    def __repr__(self) -> str:
+        return "npz"
+
+    def save(self, path, array: np.ndarray, bgr: bool = False) -> str:
+        path = str(path) + self.ext
+        np.savez_compressed(path, labels=array[:, :, ::-1] if array.ndim == 3 and bgr else array)
+        return path
+
+
+LABEL_EXTENSIONS = (PngStore.ext, NpyStore.ext, NpzStore.ext)
+
+# File name endings of the instance id images in any format
+INSTANCE_IDS_FILES = tuple(INSTANCE_IDS_SUFFIX + ext for ext in LABEL_EXTENSIONS)
+
+# File name endings and directories of the png images written next to the colormap labels, which
+# are skipped when listing the colormaps
+GENERATED_FILES = (INSTANCE_IDS_SUFFIX + PngStore.ext, "_panoptic.png")
+GENERATED_DIRS = ("_panoptic", "_semantic")
+
+
+def get_label_store(spec: str = "png"):
+    """Store from a --label-format value: "png", "png:N", "npy" or "npz"."""
+    name, _, level = spec.partition(":")
+    if name == "png":
+        return PngStore(int(level) if level else None)
+    if name == "npy" and not level:
+        return NpyStore()
+    if name == "npz" and not level:
+        return NpzStore()
+    raise ValueError(f"Unknown label format {spec}, expected png, png:N, npy or npz")
+
+
+def load_label(path, bgr: bool = False) -> np.ndarray:
+    """Read a label image saved by any store. npy files are memory-mapped."""
+    path = str(path)
+    if path.endswith(NpyStore.ext):
+        array = np.load(path, mmap_mode="r")
+    elif path.endswith(NpzStore.ext):
+        with np.load(path) as data:
+            array = data["labels"]
+    else:
+        array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if array is None:
+            raise IOError(f"Could not read {path}")
+        return array if array.ndim == 2 or bgr else cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+    return array[:, :, ::-1] if array.ndim == 3 and bgr else array
+
+
+def strip_label_suffix(name: str, suffix: str = INSTANCE_IDS_SUFFIX) -> str:
+    """File name of a label image without suffix and extension, e.g. a_instanceIds.npy -> a."""
+    for ext in LABEL_EXTENSIONS:
+        if name.endswith(suffix + ext):
+            return name[:-len(suffix + ext)]
+    return name
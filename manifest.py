@@ -0,0 +1,173 @@
+"""
+Per-stage manifests for incremental preprocessing reruns.
+
+A manifest records, for every input file a stage processed, a hash of the input's content,
+the version of the label definitions it was processed with, the output files it produced
+and the image id it was given. On a rerun only inputs that are new, changed or whose
+outputs are missing are processed again, and the annotation JSON files are patched with
+their entries instead of being rebuilt from scratch.
+
+Input keys are paths relative to the stage's input directory and outputs are stored relative
+to the manifest's directory, so a dataset can be moved without invalidating its manifests.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from executor import parallel_imap
+
+
+def file_hash(path) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_coco_entries(annotations_file) -> dict:
+    """Map image id -> (image entry, [annotation entries]) of an existing COCO annotations file."""
+    if not os.path.exists(annotations_file):
+        return {}
+
+    with open(annotations_file) as f:
+        data = json.load(f)
+
+    entries = {image["id"]: (image, []) for image in data["images"]}
+    for annotation in data["annotations"]:
+        if annotation["image_id"] in entries:
+            entries[annotation["image_id"]][1].append(annotation)
+    return entries
+
+
+class StageManifest:
+    def __init__(self, path, labels_version: str):
+        self.path = Path(path)
+        self.labels_version = labels_version
+        self.entries = {}
+        self.next_image_id = 0
+
+        if self.path.exists():
+            with open(self.path) as f:
+                data = json.load(f)
+            self.entries = data["entries"]
+            self.next_image_id = data["next_image_id"]
+
+    def _outputs_exist(self, entry: dict) -> bool:
+        return all(self.path.parent.joinpath(output).exists() for output in entry["outputs"])
+
+    def _is_current(self, key: str, input_path, known_image_ids) -> bool:
+        entry = self.entries.get(key)
+        if entry is None or entry.get("labels_version") != self.labels_version or not self._outputs_exist(entry):
+            return False
+        if known_image_ids is not None and entry.get("image_id") not in known_image_ids:
+            return False
+
+        # Only hash the input again if its size or modification time changed
+        stat = os.stat(input_path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["hash"] == file_hash(input_path):
+            entry["mtime"] = stat.st_mtime
+            return True
+        return False
+
+    def plan_stream(self, inputs, known_image_ids=None):
+        """
+        Streaming version of plan for an iterable of (key, path) inputs, such as
+        splits.iter_label_files. Yields the (key, path) of every input to (re)process as soon as it's
+        found. The keys to (re)process are appended to self.pending and the up to date ones to
+        self.unchanged, and all inputs are kept in self.inputs. Call pop_removed once it's exhausted.
+        """
+        self.inputs, self.pending, self.unchanged = {}, [], []
+        for key, input_path in inputs:
+            self.inputs[key] = input_path
+            if self._is_current(key, input_path, known_image_ids):
+                self.unchanged.append(key)
+            else:
+                self.pending.append(key)
+                yield key, input_path
+
+    def pop_removed(self) -> list:
+        """Remove and return the entries of the inputs that weren't found by the last plan."""
+        return [self.entries.pop(key) for key in sorted(set(self.entries) - set(self.inputs))]
+
+    def plan(self, inputs: dict, known_image_ids=None) -> tuple:
+        """
+        inputs maps input keys to input paths. known_image_ids are the image ids found in the
+        stage's existing annotation files, if it writes any.
+        Returns (pending, unchanged, removed): sorted keys to (re)process, sorted keys whose
+        outputs are up to date, and the manifest entries of inputs that no longer exist.
+        """
+        for _ in self.plan_stream(sorted(inputs.items()), known_image_ids):
+            pass
+        return self.pending, self.unchanged, self.pop_removed()
+
+    def process(self, inputs, func, make_task, add_result, add_unchanged=None, known_image_ids=None, n_proc: int = 1, **imap_kwargs):
+        """
+        Run func in the shared worker pool (see executor.parallel_imap, imap_kwargs are passed
+        through) on the inputs that are new, changed or whose outputs are missing, while inputs,
+        an iterable of (key, path), is still being listed. New inputs get their image ids in that order.
+            - make_task(path, image_id) returns the task of an input
+            - add_result(result) handles the result of a task, in input order, and returns the
+              outputs to record for its input
+            - add_unchanged(image_id) copies the existing entries of an up to date input; it's
+              called after every result was added
+        The outputs of the inputs that no longer exist are removed and the manifest is saved.
+        """
+        tasks = (make_task(path, self.get_image_id(key)) for key, path in self.plan_stream(inputs, known_image_ids))
+        for index, result in enumerate(parallel_imap(func, tasks, n_proc, **imap_kwargs)):
+            key = self.pending[index]
+            self.record(key, self.inputs[key], add_result(result))
+
+        if add_unchanged is not None:
+            for key in self.unchanged:
+                add_unchanged(self.get_image_id(key))
+
+        removed = self.pop_removed()
+        self.remove_outputs(removed)
+        self.save()
+        print(f"{len(self.pending)} new or changed files, {len(self.unchanged)} up to date, {len(removed)} removed")
+
+    def get_image_id(self, key: str) -> int:
+        """Image id of an input. Inputs keep their id across reruns, new inputs get a new one."""
+        entry = self.entries.get(key)
+        if entry is not None and "image_id" in entry:
+            return entry["image_id"]
+
+        self.entries.setdefault(key, {})["image_id"] = self.next_image_id
+        self.next_image_id += 1
+        return self.entries[key]["image_id"]
+
+    def record(self, key: str, input_path, outputs: list = ()):
+        stat = os.stat(input_path)
+        entry = self.entries.setdefault(key, {})
+        entry.update({
+            "hash": file_hash(input_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "labels_version": self.labels_version,
+            "outputs": [os.path.relpath(output, self.path.parent) for output in outputs],
+        })
+
+    def remove_outputs(self, entries: list):
+        # Keep the outputs that a current input now writes too, e.g. a.png after a_instanceIds.png
+        # was replaced by a_instanceIds.npy
+        kept = {output for entry in self.entries.values() for output in entry.get("outputs", [])}
+        for entry in entries:
+            for output in entry.get("outputs", []):
+                output_path = self.path.parent.joinpath(output)
+                if output not in kept and output_path.exists():
+                    os.remove(output_path)
+
+    def save(self):
+        # Drop entries of inputs that were given an id but never recorded (e.g. a failed run)
+        entries = {key: entry for key, entry in self.entries.items() if "hash" in entry}
+        with open(self.path, "w") as f:
+            json.dump({
+                "labels_version": self.labels_version,
+                "next_image_id": self.next_image_id,
+                "entries": entries,
+            }, f, sort_keys=True, indent=4)
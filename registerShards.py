@@ -0,0 +1,103 @@
+"""
+Detectron2 dataset registration for the shards created by exportShards.py.
+
+Usage Example:
+    from registerShards import ShardDatasetMapper, register_sharded_panoptic_separated
+
+    register_sharded_panoptic_separated(
+        "RUGD_train",
+        {},
+        "RUGD_dataset_conv/train",
+        "RUGD_labels/train_shards",
+        "RUGD_labels/annotations_train_instances.json")
+
+    class Trainer(DefaultTrainer):
+        @classmethod
+        def build_train_loader(cls, cfg):
+            return build_detection_train_loader(cfg, mapper=ShardDatasetMapper(cfg, True))
+
+Like register_coco_panoptic_separated, the dataset is registered as <name>_separated and its
+dicts hold the instance annotations of annotations_<name>_instances.json. Instead of the
+sem_seg_file_name of every image, they reference the image's record in the shards, and
+ShardDatasetMapper reads the image and its semantic image from the memory-mapped shards.
+"""
+
+import copy
+
+import numpy as np
+import torch
+from detectron2.data import DatasetCatalog, DatasetMapper, MetadataCatalog
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+from detectron2.data.datasets import load_coco_json
+
+from shards import ShardReader
+
+# ShardReader of every shard directory opened by this process
+_readers = {}
+
+
+def get_shard_reader(shard_dir: str) -> ShardReader:
+    reader = _readers.get(shard_dir)
+    if reader is None:
+        reader = _readers[shard_dir] = ShardReader(shard_dir)
+    return reader
+
+
+def load_sharded_json(instances_json: str, image_root: str, shard_dir: str, dataset_name: str = None) -> list:
+    reader = get_shard_reader(shard_dir)
+    dataset_dicts = load_coco_json(instances_json, image_root, dataset_name)
+    for record in dataset_dicts:
+        record["shard_dir"] = shard_dir
+        record["shard_position"] = reader.position(record["file_name"])
+    return dataset_dicts
+
+
+def register_sharded_panoptic_separated(name, metadata, image_root, shard_dir, instances_json, panoptic_root=None, panoptic_json=None, sem_seg_root=None):
+    """
+    Arguments match register_coco_panoptic_separated, with shard_dir instead of the semantic images.
+    panoptic_root, panoptic_json and sem_seg_root are only needed by the panoptic and semantic evaluators.
+    """
+    separated_name = name + "_separated"
+    DatasetCatalog.register(separated_name, lambda: load_sharded_json(instances_json, image_root, shard_dir, separated_name))
+    MetadataCatalog.get(separated_name).set(
+        panoptic_root=panoptic_root,
+        image_root=image_root,
+        panoptic_json=panoptic_json,
+        sem_seg_root=sem_seg_root,
+        json_file=instances_json,
+        shard_dir=shard_dir,
+        evaluator_type="coco_panoptic_seg",
+        ignore_label=255,
+        **metadata,
+    )
+
+
+class ShardDatasetMapper(DatasetMapper):
+    """DatasetMapper that reads the image and semantic image of a dataset dict from its shard record."""
+
+    def __call__(self, dataset_dict):
+        dataset_dict = copy.deepcopy(dataset_dict)
+        reader = get_shard_reader(dataset_dict["shard_dir"])
+        position = dataset_dict["shard_position"]
+
+        image = reader.read_image(position, self.image_format)
+        utils.check_image_size(dataset_dict, image)
+        sem_seg_gt = reader.read_semantic(position)
+
+        aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
+        transforms = self.augmentations(aug_input)
+        image, sem_seg_gt = aug_input.image, aug_input.sem_seg
+
+        image_shape = image.shape[:2]
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        dataset_dict["sem_seg"] = torch.as_tensor(sem_seg_gt.astype("long"))
+
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            return dataset_dict
+
+        if "annotations" in dataset_dict:
+            self._transform_annotations(dataset_dict, transforms, image_shape)
+
+        return dataset_dict
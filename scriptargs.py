@@ -0,0 +1,13 @@
+"""
+Command line arguments of the preprocessing scripts.
+
+The scripts take positional arguments (e.g. input_dir, rugd|rellis, n_proc) and --flag or
+--key=value options in any order. Their mains are also called from the notebooks with a list
+of arguments, where n_proc is often an int.
+"""
+
+
+def split_args(args) -> tuple:
+    """Return (positional arguments, options) of a script's arguments, all as strings."""
+    args = [str(arg) for arg in args]
+    return [arg for arg in args if not arg.startswith("--")], [arg for arg in args if arg.startswith("--")]
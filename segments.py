@@ -0,0 +1,125 @@
+"""
+Single-pass segment statistics for panoptic annotations.
+
+Instead of building a full-image mask per segment, the areas are computed with one
+bincount over the instance id image and the bounding boxes with one
+scipy.ndimage.find_objects pass, so the cost no longer grows with the number of segments.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from scipy import ndimage
+
+from labels import get_label_registry
+
+# Value panopticapi assigns to thing pixels when converting panoptic to semantic images with --things_other
+THINGS_OTHER_ID = 183
+
+
+def id2rgb(instance_ids: np.ndarray) -> np.ndarray:
+    """Encode segment ids as COCO panoptic RGB colors (id = R + 256 * G + 256^2 * B)."""
+    instance_ids = instance_ids.astype(np.uint32)
+    rgb = np.empty(instance_ids.shape + (3,), dtype=np.uint8)
+    rgb[..., 0] = instance_ids & 0xFF
+    rgb[..., 1] = (instance_ids >> 8) & 0xFF
+    rgb[..., 2] = (instance_ids >> 16) & 0xFF
+    return rgb
+
+
+def get_segment_stats(instance_ids: np.ndarray) -> tuple:
+    """
+    Return (segment_ids, category_ids, areas, bboxes) arrays of every non-void segment in the image,
+    with bboxes as [x, y, width, height] rows.
+    """
+    areas = np.bincount(instance_ids.ravel())
+    segment_ids = np.nonzero(areas)[0]
+    segment_ids = segment_ids[segment_ids != 0]
+    category_ids = np.where(segment_ids >= 1000, segment_ids // 1000, segment_ids)
+
+    # Slices for label n are stored at index n - 1
+    bounding_slices = ndimage.find_objects(instance_ids.astype(np.int32, copy=False))
+    bboxes = np.array([
+        [cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start]
+        for rows, cols in (bounding_slices[seg_id - 1] for seg_id in segment_ids)
+    ], dtype=np.int64).reshape(-1, 4)
+
+    return segment_ids, category_ids, areas[segment_ids], bboxes
+
+
+def get_segments_info(instance_ids: np.ndarray, stats: tuple = None) -> list:
+    """
+    Return the COCO panoptic segments_info entries of every non-void segment in the image.
+    stats are the get_segment_stats of instance_ids, if they were already computed.
+    """
+    if stats is None:
+        stats = get_segment_stats(instance_ids)
+    segment_ids, category_ids, areas, bboxes = stats
+
+    return [
+        {
+            "id": seg_id,
+            "category_id": category_id,
+            "area": area,
+            "bbox": bbox,
+            "bbox_mode": 1, # XYWH_ABS=1 see https://detectron2.readthedocs.io/en/latest/modules/structures.html
+            "iscrowd": 0
+        }
+        for seg_id, category_id, area, bbox in zip(segment_ids.tolist(), category_ids.tolist(), areas.tolist(), bboxes.tolist())
+    ]
+
+
+def generate_panoptic_segments(instance_ids: np.ndarray, stats: tuple = None) -> tuple:
+    """Return the panoptic RGB image and segments_info for an instance id image."""
+    return id2rgb(instance_ids), get_segments_info(instance_ids, stats)
+
+
+def rgb2id(pan_format: np.ndarray) -> np.ndarray:
+    """Decode COCO panoptic RGB colors back to segment ids."""
+    pan_format = pan_format.astype(np.uint32)
+    return pan_format[..., 0] + (pan_format[..., 1] << 8) + (pan_format[..., 2] << 16)
+
+
+def get_category_to_semantic(isthing: np.ndarray, things_other: bool = True) -> np.ndarray:
+    """
+    Lookup table from category id to semantic image value. isthing is a boolean array indexed by label id.
+    With things_other, thing categories are mapped to THINGS_OTHER_ID the same way
+    panopticapi's panoptic2semantic_segmentation --things_other does.
+    """
+    category_to_semantic = np.arange(len(isthing), dtype=np.uint8)
+    if things_other:
+        category_to_semantic[isthing] = THINGS_OTHER_ID
+    return category_to_semantic
+
+
+@lru_cache(maxsize=None)
+def get_label_category_to_semantic(is_rugd: bool = True, things_other: bool = True) -> np.ndarray:
+    """Read-only get_category_to_semantic of the label registry, built once per process."""
+    category_to_semantic = get_category_to_semantic(get_label_registry(is_rugd).isthing, things_other)
+    category_to_semantic.setflags(write=False)
+    return category_to_semantic
+
+
+def get_semantic_image(instance_ids: np.ndarray, category_to_semantic: np.ndarray, instance_to_label: np.ndarray) -> np.ndarray:
+    """
+    Build the semantic segmentation image of an instance id image in one lookup pass.
+    instance_to_label maps instance ids to label ids (see labels.get_label_registry).
+    """
+    return category_to_semantic[instance_to_label][instance_ids]
+
+
+def panoptic_to_semantic(pan_format: np.ndarray, segments_info: list, category_to_semantic: np.ndarray) -> np.ndarray:
+    """
+    Build the semantic segmentation image of a panoptic RGB image.
+    Pixels of segments that aren't listed in segments_info are set to 0, like panopticapi does.
+    """
+    segment_ids = np.array([segment["id"] for segment in segments_info], dtype=np.int64)
+    category_ids = np.array([segment["category_id"] for segment in segments_info], dtype=np.int64)
+
+    # The last entry of the table catches every id that isn't a listed segment
+    max_id = int(segment_ids.max()) if len(segment_ids) else 0
+    segment_to_semantic = np.zeros(max_id + 2, dtype=np.uint8)
+    segment_to_semantic[segment_ids] = category_to_semantic[category_ids]
+
+    ids = np.minimum(rgb2id(pan_format), max_id + 1)
+    return segment_to_semantic[ids]
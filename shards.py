@@ -0,0 +1,154 @@
+"""
+Memory-mappable sharded storage for training data.
+
+Images and their labels are packed into a few large shard files, so data loading reads from a
+handful of memory-mapped files instead of opening thousands of small files per epoch. Images are
+kept as their encoded JPG bytes, while the semantic and panoptic labels are stored decoded (raw
+uint8 semantic ids and uint16/uint32 panoptic segment ids), so reading a label is a zero-copy view
+into the shard instead of a PNG decode.
+
+A shard directory contains
+    - shard-00000.bin, shard-00001.bin, ...: the records, every field aligned to 64 bytes
+    - index.npy: one INDEX_DTYPE row per record with its shard, offsets, sizes and shape
+    - names.txt: the file name stem of every record, in index order
+"""
+
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+ALIGNMENT = 64
+
+INDEX_DTYPE = np.dtype([
+    ("shard", np.uint32),
+    ("height", np.uint32),
+    ("width", np.uint32),
+    ("panoptic_itemsize", np.uint32),  # 0 if the panoptic ids weren't stored
+    ("image_offset", np.uint64),
+    ("image_size", np.uint64),
+    ("semantic_offset", np.uint64),
+    ("panoptic_offset", np.uint64),
+])
+
+
+class ShardWriter:
+    def __init__(self, out_dir, shard_size: int = 1 << 30):
+        """shard_size is the size in bytes after which a new shard is started."""
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.index = []
+        self.names = []
+
+        self._shard_id = -1
+        self._shard = None
+        self._next_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_id += 1
+        self._shard = open(self.out_dir.joinpath(f"shard-{self._shard_id:05d}.bin"), "wb")
+
+    def _write(self, data: bytes) -> int:
+        offset = self._shard.tell()
+        self._shard.write(data)
+        padding = -self._shard.tell() % ALIGNMENT
+        if padding:
+            self._shard.write(b"\0" * padding)
+        return offset
+
+    def add(self, name: str, image_bytes: bytes, semantic: np.ndarray, panoptic_ids: np.ndarray = None):
+        """image_bytes is the encoded image, semantic the (H, W) label image and panoptic_ids the (H, W) segment ids."""
+        if self._shard.tell() >= self.shard_size:
+            self._next_shard()
+
+        height, width = semantic.shape
+        image_offset = self._write(image_bytes)
+        semantic_offset = self._write(np.ascontiguousarray(semantic, dtype=np.uint8).tobytes())
+
+        panoptic_offset, panoptic_itemsize = 0, 0
+        if panoptic_ids is not None:
+            dtype = np.uint16 if panoptic_ids.max(initial=0) < (1 << 16) else np.uint32
+            panoptic_offset = self._write(np.ascontiguousarray(panoptic_ids, dtype=dtype).tobytes())
+            panoptic_itemsize = np.dtype(dtype).itemsize
+
+        self.index.append((self._shard_id, height, width, panoptic_itemsize, image_offset, len(image_bytes), semantic_offset, panoptic_offset))
+        self.names.append(name)
+
+    def close(self):
+        if self._shard is None:
+            return
+        self._shard.close()
+        self._shard = None
+
+        np.save(self.out_dir.joinpath("index.npy"), np.array(self.index, dtype=INDEX_DTYPE))
+        with open(self.out_dir.joinpath("names.txt"), "w") as f:
+            f.write("\n".join(self.names))
+
+
+class ShardReader:
+    def __init__(self, shard_dir):
+        self.shard_dir = Path(shard_dir)
+        self.index = np.load(self.shard_dir.joinpath("index.npy"), mmap_mode="r")
+        with open(self.shard_dir.joinpath("names.txt")) as f:
+            names = f.read().split("\n") if len(self.index) else []
+        self.positions = {name: position for position, name in enumerate(names)}
+
+        # Shards are mapped on first use, so each data loader worker maps them itself
+        self._shards = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _shard(self, shard_id: int) -> np.ndarray:
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            path = self.shard_dir.joinpath(f"shard-{shard_id:05d}.bin")
+            shard = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=np.uint8)
+            self._shards[shard_id] = shard
+        return shard
+
+    def position(self, name: str) -> int:
+        """Index position of a record from its file name (with or without extension)."""
+        return self.positions[Path(name).stem]
+
+    def read_image(self, position: int, format: str = "BGR") -> np.ndarray:
+        record = self.index[position]
+        shard = self._shard(int(record["shard"]))
+        start = int(record["image_offset"])
+        image_bytes = shard[start:start + int(record["image_size"])]
+
+        if format == "L":
+            return cv2.imdecode(image_bytes, cv2.IMREAD_GRAYSCALE)[:, :, None]
+        image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+        if format == "RGB":
+            image = image[:, :, ::-1]
+        return image
+
+    def read_semantic(self, position: int) -> np.ndarray:
+        """Read-only (H, W) uint8 view into the shard."""
+        record = self.index[position]
+        height, width = int(record["height"]), int(record["width"])
+        start = int(record["semantic_offset"])
+        return self._shard(int(record["shard"]))[start:start + height * width].reshape(height, width)
+
+    def read_panoptic(self, position: int) -> np.ndarray:
+        """Read-only (H, W) view of the panoptic segment ids, or None if they weren't exported."""
+        record = self.index[position]
+        itemsize = int(record["panoptic_itemsize"])
+        if itemsize == 0:
+            return None
+
+        height, width = int(record["height"]), int(record["width"])
+        start = int(record["panoptic_offset"])
+        data = self._shard(int(record["shard"]))[start:start + height * width * itemsize]
+        return data.view(np.uint16 if itemsize == 2 else np.uint32).reshape(height, width)
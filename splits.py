@@ -0,0 +1,125 @@
+"""
+Virtual train/test/val splits.
+
+A split manifest (e.g. <dataset_path>/labels/train.json, see generateSplitDatasets.py) lists the
+image and colormap label of every sample in the split, so a dataset can be split, or re-split
+with another test size or seed, without moving any file.
+
+The preprocessing scripts accept a split manifest wherever they take a labels directory.
+labels/train.json reads the label files listed in the manifest and writes the outputs where
+labels/train/ would have them: labels/annotations_train_panoptic.json, labels/train_panoptic/...
+"""
+
+import json
+import os
+from pathlib import Path
+
+from discovery import scan_files
+
+SPLIT_EXT = ".json"
+
+
+def is_split_manifest(input_path) -> bool:
+    return str(input_path).endswith(SPLIT_EXT) and os.path.isfile(input_path)
+
+
+def get_data_path(input_path) -> Path:
+    """Path the outputs of a stage are named after: the labels directory, or the manifest without its extension."""
+    input_path = Path(input_path)
+    if is_split_manifest(input_path):
+        return input_path.with_suffix("")
+    return input_path
+
+
+def save_split(manifest_path, samples: dict, info: dict = None):
+    """samples maps every sample name to its (image path, label path)."""
+    manifest_path = Path(manifest_path)
+    root = manifest_path.parent
+    split = {
+        "info": info or {},
+        # Paths are relative to the manifest, so the dataset directory can be moved
+        "samples": {
+            name: [os.path.relpath(image, root), os.path.relpath(label, root)]
+            for name, (image, label) in sorted(samples.items())
+        },
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(split, f, indent=4)
+
+
+def load_split(manifest_path) -> dict:
+    """Map every sample name of a split manifest to its (image path, label path)."""
+    manifest_path = Path(manifest_path)
+    with open(manifest_path) as f:
+        samples = json.load(f)["samples"]
+    root = manifest_path.parent
+    return {name: (root.joinpath(image), root.joinpath(label)) for name, (image, label) in samples.items()}
+
+
+def _most_recent(items: list) -> tuple:
+    """The (key, path) item of the most recently modified path."""
+    return items[0] if len(items) == 1 else max(items, key=lambda item: os.path.getmtime(item[1]))
+
+
+def iter_label_files(input_path, suffixes=".png", exclude_suffixes=(), exclude_dirs=()):
+    """
+    Yield the (key, path) of every label file of a labels directory or split manifest, in sorted
+    key order for a split manifest and in listing order for a directory, which is scanned lazily
+    (see discovery.py), skipping the file names ending with exclude_suffixes and the directories
+    ending with exclude_dirs.
+    suffixes (a string or tuple) select the files derived from the colormap labels, e.g.
+    "_instanceIds.png". When a label has files with several of the suffixes (e.g. the instance
+    ids were saved in another format by a previous run), only the most recent one is yielded.
+    Keys are the paths relative to the labels directory, or the file names for a split manifest.
+    """
+    if isinstance(suffixes, str):
+        suffixes = (suffixes,)
+
+    if is_split_manifest(input_path):
+        files = []
+        for _, label in load_split(input_path).values():
+            paths = [label.with_name(label.stem + suffix) for suffix in suffixes]
+            if len(suffixes) > 1:
+                paths = [path for path in paths if path.exists()]
+            if paths:
+                files.append(_most_recent([(path.name, path) for path in paths]))
+        yield from sorted(files)
+        return
+
+    # The first file found of a label is yielded along with its files with the other suffixes,
+    # which are checked right away instead of waiting for the rest of the listing
+    seen = set()
+    for key, path in scan_files(input_path, suffixes, exclude_suffixes, exclude_dirs):
+        if len(suffixes) == 1:
+            yield key, path
+            continue
+
+        suffix = next(suffix for suffix in suffixes if key.endswith(suffix))
+        base = key[:-len(suffix)]
+        if base in seen:
+            continue
+        seen.add(base)
+        items = [(key, path)] + [
+            (base + other, path.with_name(path.name[:-len(suffix)] + other))
+            for other in suffixes if other != suffix
+        ]
+        yield _most_recent([(item_key, item_path) for item_key, item_path in items if item_key == key or item_path.exists()])
+
+
+def list_label_files(input_path, suffixes=".png", exclude_suffixes=(), exclude_dirs=()) -> dict:
+    """Map the key of every label file to its path in sorted key order, see iter_label_files."""
+    return dict(sorted(iter_label_files(input_path, suffixes, exclude_suffixes, exclude_dirs)))
+
+
+def link_split_images(manifest_path, image_dir) -> Path:
+    """
+    Symlink the images of a split into image_dir, to use it as the image_root of
+    register_coco_panoptic_separated without copying the images.
+    """
+    image_dir = Path(image_dir)
+    image_dir.mkdir(parents=True, exist_ok=True)
+    for image, _ in load_split(manifest_path).values():
+        link = image_dir.joinpath(image.name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(image), link)
+    return image_dir
@@ -0,0 +1,78 @@
+"""
+label_instances must give the same instance ids as the per-pixel flood fill it replaced, including
+the order in which the regions of a thing class are numbered (column by column).
+"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+from skimage.segmentation import flood_fill
+
+from components import label_instances
+from labels import get_label_registry
+
+# Labels 0-5: void, stuff 1 and 2, things 3, 4 and 5
+ISTHING = np.array([False, False, False, True, True, True])
+
+
+def flood_fill_instances(label_ids: np.ndarray, isthing: np.ndarray) -> np.ndarray:
+    """The original createPanopticInstanceIds.generateInstanceIds scan, after the color matching."""
+    instance_ids = -label_ids.astype(np.int32)
+    segment_count = Counter()
+    y_dim, x_dim = instance_ids.shape
+    for x in range(x_dim):
+        for y in range(y_dim):
+            if instance_ids[y][x] < 0:
+                label_id = -instance_ids[y][x]
+                if isthing[label_id]:
+                    new_val = label_id * 1000 + segment_count[label_id]
+                    segment_count[label_id] += 1
+                else:
+                    new_val = label_id
+                flood_fill(instance_ids, (y, x), new_val, connectivity=1, in_place=True)
+    return instance_ids.astype(np.uint16)
+
+
+def random_label_image(rng: np.random.Generator, shape: tuple, n_labels: int, block: int) -> np.ndarray:
+    """Blocky regions of random labels, so things touch each other and other classes."""
+    coarse = rng.integers(0, n_labels, size=(shape[0] // block + 1, shape[1] // block + 1))
+    label_ids = np.kron(coarse, np.ones((block, block), dtype=coarse.dtype))[:shape[0], :shape[1]]
+    # Single pixel segments scattered over the regions
+    n_dots = shape[0] * shape[1] // 20
+    label_ids[rng.integers(0, shape[0], n_dots), rng.integers(0, shape[1], n_dots)] = rng.integers(0, n_labels, n_dots)
+    return label_ids.astype(np.uint8)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("block", [1, 3, 7])
+def test_matches_flood_fill_on_random_images(seed, block):
+    rng = np.random.default_rng(seed)
+    label_ids = random_label_image(rng, (31, 47), len(ISTHING), block)
+    np.testing.assert_array_equal(label_instances(label_ids, ISTHING), flood_fill_instances(label_ids, ISTHING))
+
+
+def test_touching_things_and_single_pixels():
+    label_ids = np.array([
+        [3, 3, 4, 4, 0, 3],
+        [3, 4, 4, 3, 0, 5],
+        [5, 5, 3, 3, 1, 3],
+        [3, 0, 1, 3, 1, 4],
+        [4, 3, 1, 2, 3, 3],
+    ], dtype=np.uint8)
+    instance_ids = label_instances(label_ids, ISTHING)
+
+    np.testing.assert_array_equal(instance_ids, flood_fill_instances(label_ids, ISTHING))
+    # Things of the same class touching only diagonally are separate instances
+    assert instance_ids[3, 0] != instance_ids[4, 1]
+    # Stuff keeps its label id and every thing pixel gets an instance id of its class
+    assert set(np.unique(instance_ids[label_ids == 1])) == {1}
+    assert np.all(instance_ids[ISTHING[label_ids]] // 1000 == label_ids[ISTHING[label_ids]])
+
+
+@pytest.mark.parametrize("is_rugd", [True, False])
+def test_matches_flood_fill_with_dataset_labels(is_rugd):
+    isthing = get_label_registry(is_rugd).isthing
+    rng = np.random.default_rng(0)
+    label_ids = random_label_image(rng, (40, 60), len(isthing), 4)
+    np.testing.assert_array_equal(label_instances(label_ids, isthing), flood_fill_instances(label_ids, isthing))